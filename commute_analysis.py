@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from commute_segments import SEGMENTS, STRAIGHT_HOME_LIMIT, time_columns
+
+
+SEGMENT_NAMES = [segment[0] for segment in SEGMENTS]
+ACTIVITIES = sorted({segment[2] for segment in SEGMENTS})
+DIRECTIONS = ['out', 'return']
+
+# The segment table flattened into index arrays, worked out once at import
+_LEG_STARTS = np.array([time_columns.index(start) for _, legs, *_ in SEGMENTS for start, _ in legs])
+_LEG_ENDS = np.array([time_columns.index(end) for _, legs, *_ in SEGMENTS for _, end in legs])
+_SEGMENT_OFFSETS = np.cumsum([0] + [len(legs) for _, legs, *_ in SEGMENTS])[:-1]
+_STRAIGHT_HOME_ONLY = np.array([segment[4] for segment in SEGMENTS])
+_ACTIVITY_CODES = np.array([ACTIVITIES.index(segment[2]) for segment in SEGMENTS])
+_DIRECTION_CODES = np.array([DIRECTIONS.index(segment[3]) for segment in SEGMENTS])
+
+
+# Marks a checkpoint that wasn't logged in checkpoint_seconds' int32 output
+MISSING = -1
+
+# Days read from the local copy at a time by load_commute_data
+CHUNK_DAYS = 1000
+
+
+def checkpoint_seconds(times):
+    """Turn a block of HH:MM:SS strings into int32 seconds since midnight, in one pass
+
+    Missing, empty or malformed times come out as MISSING. Every checkpoint is on
+    the row's own date, so seconds are all the durations need, at a quarter of the
+    memory of datetimes.
+    """
+    flat = pd.Series(times.to_numpy(dtype=object).ravel()).replace('', None)
+    offsets = pd.to_timedelta(flat, errors='coerce').to_numpy(dtype='timedelta64[ns]')
+    seconds = np.where(np.isnat(offsets), MISSING, offsets.view(np.int64) // 1_000_000_000)
+    return seconds.astype(np.int32).reshape(times.shape)
+
+
+def segment_minutes(seconds):
+    """float32 minutes of every segment in SEGMENTS, one column each in SEGMENTS order
+
+    seconds is the output of checkpoint_seconds. Every leg of every segment is
+    worked out with a single array subtraction, then legs are summed per segment;
+    a segment with a missing leg is NaN.
+    """
+    starts = seconds[:, _LEG_STARTS]
+    ends = seconds[:, _LEG_ENDS]
+    legs = np.where((starts == MISSING) | (ends == MISSING), np.nan, ends - starts).astype(np.float32)
+    return np.add.reduceat(legs, _SEGMENT_OFFSETS, axis=1) / np.float32(60)
+
+
+_TUBE_RETURN = [time_columns.index('boarded_tube_return'), time_columns.index('alighted_tube_return')]
+_DOOR_TO_DOOR = {name: SEGMENT_NAMES.index(name) for name in ('door_to_door_out', 'door_to_door_return')}
+
+
+def went_straight_home(seconds, minutes):
+    """True for days when I took the tube home and didn't stop off on the way"""
+    took_tube = (seconds[:, _TUBE_RETURN] != MISSING).all(axis=1)
+    return took_tube & ~(minutes[:, _DOOR_TO_DOOR['door_to_door_return']] > STRAIGHT_HOME_LIMIT)
+
+
+def long_durations(dates, minutes, straight_home):
+    """Long-format (date, segment, duration) pieces of one chunk, in segment order
+
+    Segment codes index SEGMENTS; they're turned into activity and direction once
+    every chunk has been read, in load_commute_data.
+    """
+    values = minutes.copy()
+    values[np.ix_(~straight_home, _STRAIGHT_HOME_ONLY)] = np.nan
+    segments, days = np.nonzero(~np.isnan(values.T))
+    return dates[days], segments.astype(np.int8), values[days, segments]
+
+
+def load_commute_data(conn, query, params=(), chunksize=CHUNK_DAYS):
+    """Read commute_logs a chunk at a time into compact per-day and long-format frames
+
+    Returns (days, durations): days has date, door_to_door_out, door_to_door_return
+    (float32 minutes) and straight_home; durations has date, duration (float32) and
+    categorical activity and direction, one row per segment per day, as the plots want.
+    Each chunk's strings and intermediate arrays are dropped before the next is read,
+    so memory grows with these compact results rather than with the raw text.
+    """
+    day_parts = []
+    duration_parts = []
+    for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize):
+        dates = pd.to_datetime(chunk['date']).to_numpy(dtype='datetime64[ns]')
+        seconds = checkpoint_seconds(chunk[time_columns])
+        del chunk
+        minutes = segment_minutes(seconds)
+        straight_home = went_straight_home(seconds, minutes)
+        day_parts.append(pd.DataFrame({
+            'date': dates,
+            'door_to_door_out': minutes[:, _DOOR_TO_DOOR['door_to_door_out']],
+            'door_to_door_return': minutes[:, _DOOR_TO_DOOR['door_to_door_return']],
+            'straight_home': straight_home,
+        }))
+        duration_parts.append(long_durations(dates, minutes, straight_home))
+        del seconds, minutes
+
+    # read_sql_query gives one empty chunk for no rows, so there's always a part
+    days = pd.concat(day_parts, ignore_index=True)
+    dates, segments, durations = (np.concatenate(part) for part in zip(*duration_parts))
+    del day_parts, duration_parts
+
+    # Back into one segment after another across the whole history, as a single melt would give
+    order = np.argsort(segments, kind='stable')
+    segments = segments[order]
+    return days, pd.DataFrame({
+        'date': dates[order],
+        'duration': durations[order],
+        'activity': pd.Categorical.from_codes(_ACTIVITY_CODES[segments], categories=ACTIVITIES),
+        'direction': pd.Categorical.from_codes(_DIRECTION_CODES[segments], categories=DIRECTIONS),
+    })
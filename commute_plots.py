@@ -0,0 +1,155 @@
+import os
+import json
+import hashlib
+import inspect
+from importlib.metadata import version
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # headless, and safe to use from worker processes
+import matplotlib.pyplot as plt
+
+# Each job gets only the slice of data its figure needs, so a worker is sent
+# one activity's rows (or one calplot series) rather than the whole durations frame.
+# seaborn and calplot are slow to import, so each plot function imports only the
+# one it uses, and --plots violin never loads calplot.
+
+
+def plot_violin(activity_data, activity, path):
+    """Split violin plot of one activity's durations, out vs return"""
+    import seaborn as sns
+    fig = plt.figure(figsize=(8, 6))
+    try:
+        sns.violinplot(
+            data=activity_data,
+            x='activity',
+            order=[activity],  # activity is categorical, so don't leave room for the others
+            y='duration',
+            hue='direction',
+            inner="points",
+            split=True,
+            bw_adjust=0.8,
+            palette=['lightblue', 'lightcoral']
+            #,inner_kws=dict(box_width=15, whis_width=1.5, color="0.4", marker="<", markersize=8)
+        )
+
+        plt.title(f'{activity.capitalize()} Duration Distribution (Out vs Return)', fontsize=14, fontweight='bold')
+        plt.xticks([])  # Remove x-axis tick labels
+        plt.xlabel('')  # Remove x-axis label
+        plt.ylabel('Duration (minutes)', fontsize=12)
+        plt.legend(title='Direction', loc='upper right')
+        plt.tight_layout()
+
+        fig.savefig(path, dpi=300, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+    return path
+
+
+def plot_totals(activity_totals, path):
+    """Bar plot of total duration by activity"""
+    import seaborn as sns
+    fig = plt.figure(figsize=(10, 6))
+    try:
+        sns.barplot(data=activity_totals, x='activity', y='duration')
+        plt.title('Total Duration by Activity')
+        plt.ylabel('Total Duration (minutes)')
+        plt.xlabel('')
+        plt.tight_layout()
+        fig.savefig(path, dpi=300, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+    return path
+
+
+def plot_calplot(series, suptitle, path):
+    """Calendar heatmap of a door-to-door series indexed by date"""
+    import calplot
+    fig, ax = calplot.calplot(series,
+                              vmin=60,
+                              vmax=90,
+                              dropzero=True,
+                              linewidth=0.2,
+                              cmap="plasma",
+                              yearlabel_kws={'fontname':'sans-serif'},
+                              suptitle=suptitle)
+    try:
+        fig.savefig(path, dpi=300, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+    return path
+
+
+# Hashes of each figure's inputs from the last run, kept next to the PNGs
+MANIFEST_PATH = '.plot_manifest.json'
+
+# Libraries whose version goes into each figure's hash. Versions come from the
+# installed package metadata, so hashing doesn't import them either.
+PLOT_LIBRARIES = {
+    'plot_violin': ['matplotlib', 'seaborn'],
+    'plot_totals': ['matplotlib', 'seaborn'],
+    'plot_calplot': ['matplotlib', 'calplot'],
+}
+
+
+def job_key(function, args):
+    """Hash of everything that affects a figure: its data, its parameters and the plotting code"""
+    digest = hashlib.sha256()
+    digest.update(inspect.getsource(function).encode())
+    libraries = PLOT_LIBRARIES.get(function.__name__, ['matplotlib'])
+    digest.update(' '.join(version(library) for library in libraries).encode())
+    for arg in args:
+        if isinstance(arg, (pd.DataFrame, pd.Series)):
+            # A frame's index is only its position in the durations frame, which a new
+            # day shifts for every later segment, so only its values (dates included)
+            # count. A calplot series is indexed by date, so there the index is data.
+            index = isinstance(arg, pd.Series)
+            digest.update(pd.util.hash_pandas_object(arg, index=index).to_numpy().tobytes())
+            shape = arg.dtypes.to_dict() if isinstance(arg, pd.DataFrame) else {arg.name: arg.dtype}
+            digest.update(repr(shape).encode())
+        else:
+            digest.update(repr(arg).encode())
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    # Write then rename, so an interrupted run can't leave a half-written manifest
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def render_all(jobs, workers=None, manifest_path=MANIFEST_PATH, force=False):
+    """Run (function, args) plot jobs across a pool of processes, returning the paths written
+
+    The last argument of every job is the file it writes. Jobs whose inputs hash the
+    same as last time (per the manifest) and whose file is still there are skipped.
+    workers defaults to one per CPU core (capped at the number of jobs to run); with
+    workers=1 everything is drawn in this process, which is handy for debugging.
+    """
+    manifest = {} if force else load_manifest(manifest_path)
+    keys = [job_key(function, args) for function, args in jobs]
+    todo = [(job, key) for job, key in zip(jobs, keys)
+            if manifest.get(job[1][-1]) != key or not os.path.exists(job[1][-1])]
+    if not todo:
+        return []
+
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    if workers <= 1:
+        written = [function(*args) for (function, args), _ in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(function, *args) for (function, args), _ in todo]
+            written = [future.result() for future in futures]
+
+    manifest.update({path: key for path, (_, key) in zip(written, todo)})
+    save_manifest(manifest_path, manifest)
+    return written
@@ -0,0 +1,104 @@
+# Segment definitions shared by the backend and the visualiser. No pandas here,
+# so the Flask app on the Pi can import it too.
+
+# Checkpoint columns of commute_logs, in the order they're laid out in the table
+time_columns = [
+    'left_home', 'boarded_train_out', 'alighted_train_out', 'boarded_tube_out',
+    'alighted_tube_out', 'arrived_at_scale_space', 'left_scale_space',
+    'boarded_tube_return', 'alighted_tube_return', 'boarded_train_return',
+    'alighted_train_return', 'arrived_at_station', 'left_station', 'arrived_at_home'
+]
+
+# Every duration we report, as
+#   (segment, legs, activity, direction, straight_home_only)
+# where legs are (start checkpoint, end checkpoint) pairs whose durations are added
+# together. A segment is missing for a day if any of its legs is. Adding a new leg
+# of the commute is a matter of adding a row here.
+SEGMENTS = [
+    ('cycle_there', [('left_home', 'arrived_at_station')], 'cycling', 'out', False),
+    ('train_out', [('boarded_train_out', 'alighted_train_out')], 'train', 'out', False),
+    ('tube_out', [('boarded_tube_out', 'alighted_tube_out')], 'tube', 'out', False),
+    ('walking_to_scalespace', [('alighted_tube_out', 'arrived_at_scale_space')], 'walking', 'out', False),
+    ('door_to_door_out', [('left_home', 'arrived_at_scale_space')], 'door2door', 'out', False),
+    ('transferring_out', [('arrived_at_station', 'boarded_train_out'),
+                          ('alighted_train_out', 'boarded_tube_out')], 'transferring', 'out', False),
+    ('walking_to_woodlane', [('left_scale_space', 'boarded_tube_return')], 'walking', 'return', False),
+    ('tube_return', [('boarded_tube_return', 'alighted_tube_return')], 'tube', 'return', False),
+    ('train_return', [('boarded_train_return', 'alighted_train_return')], 'train', 'return', False),
+    ('cycle_home', [('left_station', 'arrived_at_home')], 'cycling', 'return', False),
+    ('door_to_door_return', [('left_scale_space', 'arrived_at_home')], 'door2door', 'return', True),
+    ('transferring_return', [('alighted_tube_return', 'boarded_train_return'),
+                             ('alighted_train_return', 'left_station')], 'transferring', 'return', True),
+]
+
+# If I've gone out in Reading after work that's not going straight home
+STRAIGHT_HOME_LIMIT = 180  # minutes, door to door
+
+# Checkpoints in the order they're passed on each journey, ending at its destination.
+# Each pair of neighbours is a leg, whose durations are kept in commute_legs for
+# predicting arrival times (/api/eta). This is the original Reading to Scale Space
+# route; others are stored in the routes table in the same shape.
+JOURNEYS = {
+    'out': ['left_home', 'arrived_at_station', 'boarded_train_out', 'alighted_train_out',
+            'boarded_tube_out', 'alighted_tube_out', 'arrived_at_scale_space'],
+    'return': ['left_scale_space', 'boarded_tube_return', 'alighted_tube_return', 'boarded_train_return',
+               'alighted_train_return', 'left_station', 'arrived_at_home'],
+}
+
+# A leg longer than this was a detour (or a typo), not a prediction worth making
+MAX_LEG_MINUTES = 120
+
+
+def time_to_seconds(value):
+    """Seconds since midnight for an HH:MM:SS string, or None if it's missing or malformed"""
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    except (AttributeError, ValueError):
+        return None
+
+
+def day_segments(record):
+    """Durations of every segment for one commute_logs row
+
+    Returns (straight_home, [(segment, activity, direction, duration_seconds), ...]),
+    leaving out segments with a missing checkpoint. Segments marked straight_home_only
+    are included regardless; filtering them is up to whoever reads them.
+    """
+    seconds = {}
+    durations = []
+    for segment, legs, activity, direction, _ in SEGMENTS:
+        total = 0
+        for start, end in legs:
+            for checkpoint in (start, end):
+                if checkpoint not in seconds:
+                    seconds[checkpoint] = time_to_seconds(record.get(checkpoint))
+            if seconds[start] is None or seconds[end] is None:
+                break
+            total += seconds[end] - seconds[start]
+        else:
+            durations.append((segment, activity, direction, total))
+
+    took_tube = record.get('boarded_tube_return') is not None and record.get('alighted_tube_return') is not None
+    door_to_door_return = next((d[3] for d in durations if d[0] == 'door_to_door_return'), None)
+    straight_home = took_tube and not (door_to_door_return is not None and door_to_door_return > STRAIGHT_HOME_LIMIT * 60)
+    return straight_home, durations
+
+
+def day_legs(record, journeys=JOURNEYS):
+    """Every leg of one commute_logs row with both ends logged, for a route's journeys
+
+    Returns [(leg, start_seconds, duration_seconds), ...], where a leg is named after
+    the checkpoint it starts from.
+    """
+    legs = []
+    for checkpoints in journeys.values():
+        for start, end in zip(checkpoints, checkpoints[1:]):
+            start_seconds = time_to_seconds(record.get(start))
+            end_seconds = time_to_seconds(record.get(end))
+            if start_seconds is None or end_seconds is None:
+                continue
+            duration = end_seconds - start_seconds
+            if 0 <= duration <= MAX_LEG_MINUTES * 60:
+                legs.append((start, start_seconds, duration))
+    return legs
@@ -1,326 +1,207 @@
-import sqlite3
-import pandas as pd
-import requests
-import tempfile
+#! python3
+# Commute stats and plots, from a local copy of the CommuteTrackr database.
+#   python commute_visualisr.py                           sync, print totals, draw every plot
+#   python commute_visualisr.py --totals-only --since week --no-sync
+#   python commute_visualisr.py --plots violin,calplot --since 2025-01-01
+#   python commute_visualisr.py --user sam                for someone else's commute
+# pandas, matplotlib, seaborn and calplot are only imported when a plot is wanted,
+# so a quick totals check doesn't pay for them.
+
+import argparse
 import os
-import matplotlib.pyplot as plt
-import seaborn as sns
-import calplot
-
-response = requests.get("http://192.168.0.101:1010/commutetrackr.db")
-temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
-temp_file.write(response.content)
-temp_file.close()
-db_temp_path = temp_file.name
-print(f'Database downloaded successfully.\nSize: {len(response.content)} bytes.\nLocation: {db_temp_path}\n\n')
-
-conn = sqlite3.connect(db_temp_path)
-
-# Get values from the database, ignoring days where there was zero activity (in which every column contains a NULL)
-query = """
-SELECT *
-FROM commute_logs
-WHERE NOT (
-    left_home IS NULL AND
-    boarded_train_out IS NULL AND
-    alighted_train_out IS NULL AND
-    boarded_tube_out IS NULL AND
-    alighted_tube_out IS NULL AND
-    arrived_at_scale_space IS NULL AND
-    left_scale_space IS NULL AND
-    boarded_tube_return IS NULL
-)
-"""
-
-df = pd.read_sql_query(query, conn)
-conn.close()
-
-# Clean up temporary database file
-if os.path.exists(db_temp_path):
-    os.unlink(db_temp_path)
-
-# Create a 'straight_home' column
-df['straight_home'] = df['boarded_tube_return'].notnull() & df['alighted_tube_return'].notnull()
-
-#Convert time columns to datetime objects and extract useful features
-df['date'] = pd.to_datetime(df['date'])
-
-time_columns = [
-    'left_home', 'boarded_train_out', 'alighted_train_out', 'boarded_tube_out', 
-    'alighted_tube_out', 'arrived_at_scale_space', 'left_scale_space', 
-    'boarded_tube_return', 'alighted_tube_return', 'boarded_train_return', 
-    'alighted_train_return', 'arrived_at_station', 'left_station', 'arrived_at_home'
-]
-
-for col in time_columns:
-    df[f'{col}_dt'] = df.apply(lambda row: 
-        pd.to_datetime(f'{row['date'].date()} {row[col]}') 
-        if pd.notna(row[col]) and row[col] != '' else pd.NaT, axis=1)
-
-
-# Calculate durations for different segments of the journey
-
-# cycle_there: 'left_home' > 'arrived_at_station'
-# transferring_to_train_out: 'arrived_at_station' > 'boarded_train_out'
-# train_out: 'boarded_train_out' > 'alighted_train_out'
-# transferring_to_tube_out: 'alighted_train_out' > 'boarded_tube_out'
-# tube_out: 'boarded_tube_out' > 'alighted_tube_out'
-# walking_to_scalespace: 'alighted_tube_out' > 'arrived_at_scale_space'
-# door_to_door_out: 'left_home' > 'arrived_at_scale_space'
-
-if 'left_home_dt' in df.columns and 'arrived_at_station_dt' in df.columns:
-    df['cycle_there'] = (df['arrived_at_station_dt'] - df['left_home_dt']).dt.total_seconds() / 60
-
-if 'boarded_train_out_dt' in df.columns and 'arrived_at_station_dt' in df.columns:
-    df['transferring_to_train_out'] = (df['boarded_train_out_dt'] - df['arrived_at_station_dt']).dt.total_seconds() / 60
-
-if 'alighted_train_out_dt' in df.columns and 'boarded_train_out_dt' in df.columns:
-    df['train_out'] = (df['alighted_train_out_dt'] - df['boarded_train_out_dt']).dt.total_seconds() / 60
-
-if 'boarded_tube_out_dt' in df.columns and 'alighted_train_out_dt' in df.columns:
-    df['transferring_to_tube_out'] = (df['boarded_tube_out_dt'] - df['alighted_train_out_dt']).dt.total_seconds() / 60
-
-if 'alighted_tube_out_dt' in df.columns and 'boarded_tube_out_dt' in df.columns:
-    df['tube_out'] = (df['alighted_tube_out_dt'] - df['boarded_tube_out_dt']).dt.total_seconds() / 60
-
-if 'arrived_at_scale_space_dt' in df.columns and 'alighted_tube_out_dt' in df.columns:
-    df['walking_to_scalespace'] = (df['arrived_at_scale_space_dt'] - df['alighted_tube_out_dt']).dt.total_seconds() / 60
-
-if 'arrived_at_scale_space_dt' in df.columns and 'left_home_dt' in df.columns:
-    df['door_to_door_out'] = (df['arrived_at_scale_space_dt'] - df['left_home_dt']).dt.total_seconds() / 60
-
-# walking_to_woodlane: 'left_scale_space' > 'boarded_tube_return'
-# tube_return: 'boarded_tube_return' > 'alighted_tube_return'
-# transferring_to_train_return: 'alighted_tube_return' > 'boarded_train_return'
-# train_return: 'boarded_train_return' > 'alighted_train_return'
-# walk_to_bike: 'alighted_train_return' > 'left_station'
-# cycle_home: 'left_station' > 'arrived_at_home'
-# door_to_door_return: 'left_scale_space' > 'arrived_at_home'
-
-if 'boarded_tube_return_dt' in df.columns and 'left_scale_space_dt' in df.columns:
-    df['walking_to_woodlane'] = (df['boarded_tube_return_dt'] - df['left_scale_space_dt']).dt.total_seconds() / 60
-
-if 'alighted_tube_return_dt' in df.columns and 'boarded_tube_return_dt' in df.columns:
-    df['tube_return'] = (df['alighted_tube_return_dt'] - df['boarded_tube_return_dt']).dt.total_seconds() / 60
-
-if 'boarded_train_return_dt' in df.columns and 'alighted_tube_return_dt' in df.columns:
-    df['transferring_to_train_return'] = (df['boarded_train_return_dt'] - df['alighted_tube_return_dt']).dt.total_seconds() / 60
-
-if 'alighted_train_return_dt' in df.columns and 'boarded_train_return_dt' in df.columns:
-    df['train_return'] = (df['alighted_train_return_dt'] - df['boarded_train_return_dt']).dt.total_seconds() / 60
-
-if 'left_station_dt' in df.columns and 'alighted_train_return_dt' in df.columns:
-    df['walk_to_bike'] = (df['left_station_dt'] - df['alighted_train_return_dt']).dt.total_seconds() / 60
-
-if 'arrived_at_home_dt' in df.columns and 'left_station_dt' in df.columns:
-    df['cycle_home'] = (df['arrived_at_home_dt'] - df['left_station_dt']).dt.total_seconds() / 60
-
-if 'arrived_at_home_dt' in df.columns and 'left_scale_space_dt' in df.columns:
-    df['door_to_door_return'] = (df['arrived_at_home_dt'] - df['left_scale_space_dt']).dt.total_seconds() / 60
-
-# If I've gone out in Reading after work that's not going straight home
-df.loc[df['door_to_door_return'] > 180, 'straight_home'] = False
-
-
-# Cycle there
-valid_rows = df[df['cycle_there'].notnull()]
-cycle_there_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['cycle_there'],
-    "activity": "cycling",
-    "direction": "out"
-})
-
-# Train out
-valid_rows = df[df['train_out'].notnull()]
-train_out_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['train_out'],
-    "activity": "train",
-    "direction": "out"
-})
-
-# Tube out
-valid_rows = df[df['tube_out'].notnull()]
-tube_out_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['tube_out'],
-    "activity": "tube",
-    "direction": "out"
-})
-
-# Transferring out (sum of transferring_to_train_out and transferring_to_tube_out)
-valid_rows = df[(df['transferring_to_train_out'].notnull()) & (df['transferring_to_tube_out'].notnull())]
-transferring_out_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['transferring_to_train_out'] + valid_rows['transferring_to_tube_out'],
-    "activity": "transferring",
-    "direction": "out"
-})
-
-# Walking to Scale Space
-valid_rows = df[df['walking_to_scalespace'].notnull()]
-walking_to_scalespace_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['walking_to_scalespace'],
-    "activity": "walking",
-    "direction": "out"
-})
-
-# Door to door out
-valid_rows = df[df['door_to_door_out'].notnull()]
-door_to_door_out_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['door_to_door_out'],
-    "activity": "door2door",
-    "direction": "out"
-})
-
-# Walking to Wood Lane
-valid_rows = df[df['walking_to_woodlane'].notnull()]
-walking_to_woodlane_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['walking_to_woodlane'],
-    "activity": "walking",
-    "direction": "return"
-})
-
-# Tube return
-valid_rows = df[df['tube_return'].notnull()]
-tube_return_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['tube_return'],
-    "activity": "tube",
-    "direction": "return"
-})
-
-# Train return
-valid_rows = df[df['train_return'].notnull()]
-train_return_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['train_return'],
-    "activity": "train",
-    "direction": "return"
-})
-
-# Transferring return (sum of transferring_to_train_return and walk_to_bike)
-valid_rows = df[(df['transferring_to_train_return'].notnull()) & (df['walk_to_bike'].notnull()) & (df['straight_home'] == True)]
-transferring_return_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['transferring_to_train_return'] + valid_rows['walk_to_bike'],
-    "activity": "transferring",
-    "direction": "return"
-})
-
-# Cycle home
-valid_rows = df[df['cycle_home'].notnull()]
-cycle_home_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['cycle_home'],
-    "activity": "cycling",
-    "direction": "return"
-})
-
-# Door to door return
-valid_rows = df[(df['door_to_door_return'].notnull()) & (df['straight_home'] == True)]
-door_to_door_return_df = pd.DataFrame({
-    "date": valid_rows['date'],
-    "duration": valid_rows['door_to_door_return'],
-    "activity": "door2door",
-    "direction": "return"
-})
-
-# Combine all into one durations dataframe
-durations = pd.concat([
-    cycle_there_df,
-    train_out_df,
-    tube_out_df,
-    walking_to_scalespace_df,
-    door_to_door_out_df,
-    transferring_out_df,
-    walking_to_woodlane_df,
-    tube_return_df,
-    train_return_df,
-    cycle_home_df,
-    door_to_door_return_df,
-    transferring_return_df
-], ignore_index=True)
-
-
-
-total_time_commuting = df.loc[(df['door_to_door_return'].notnull()) & (df['straight_home'] == True)].door_to_door_return.sum() + df.door_to_door_out.sum()
-hours = int(total_time_commuting // 60)
-minutes = int(total_time_commuting % 60)
-print(f"Total time spent commuting: {hours}h {minutes}m\n(excluding days when I didn't come straight home)\n\n")
-
-
-# Get list of unique activities to loop over
-activities = durations['activity'].unique()
-
-# Create separate figures for each activity
-for activity in activities:
-    # Filter data for current activity
-    activity_data = durations[durations['activity'] == activity]
-    
-    # Create figure
-    plt.figure(figsize=(8, 6))
-    
-    # Create split violin plot
-    sns.violinplot(
-        data=activity_data,
-        x='activity',
-        y='duration',
-        hue='direction',
-        inner="points",
-        split=True,
-        bw_adjust=0.8,
-        palette=['lightblue', 'lightcoral']
-        #,inner_kws=dict(box_width=15, whis_width=1.5, color="0.4", marker="<", markersize=8)
+import sqlite3
+from datetime import date, timedelta
+from commute_segments import time_columns, day_segments
+
+SERVER_URL = "http://192.168.0.101:1010/commutetrackr"
+
+# Local copy of commute_logs. Each run only downloads the days that changed since
+# the last one (tracked by the server's sync version) and merges them in here.
+# Other users get a copy each, named after them.
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.commutetrackr', 'commutetrackr_cache.db')
+
+PLOT_KINDS = ['violin', 'bar', 'calplot']
+
+
+def cache_path(user=None):
+    if not user:
+        return CACHE_PATH
+    base, extension = os.path.splitext(CACHE_PATH)
+    return f'{base}_{user}{extension}'
+
+
+def open_local_cache(user=None):
+    """Connection to the local copy, creating it if this is the first run"""
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(cache_path(user))
+    conn.execute(f"CREATE TABLE IF NOT EXISTS commute_logs (date TEXT PRIMARY KEY, {', '.join(f'{col} TEXT' for col in time_columns)})")
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_state (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    return conn
+
+
+def sync_local_cache(conn, user=None):
+    """Merge the days that changed on the server into the local copy"""
+    import requests
+
+    row = conn.execute("SELECT version FROM sync_state").fetchone()
+    since_version = row[0] if row else 0
+    user_params = {'user': user} if user else {}
+
+    response = requests.get(f"{SERVER_URL}/api/logs", params={'since_version': since_version, **user_params}, timeout=60)
+    response.raise_for_status()
+    changes = response.json()
+
+    if changes['version'] < since_version:
+        # The server's database has been replaced or restored, so start again from scratch
+        conn.execute("DELETE FROM commute_logs")
+        response = requests.get(f"{SERVER_URL}/api/logs", params={'since_version': 0, **user_params}, timeout=60)
+        response.raise_for_status()
+        changes = response.json()
+
+    upsert = (f"INSERT INTO commute_logs (date, {', '.join(time_columns)}) VALUES (?{', ?' * len(time_columns)}) "
+              f"ON CONFLICT(date) DO UPDATE SET {', '.join(f'{col} = excluded.{col}' for col in time_columns)}")
+    conn.executemany(upsert, ([record['date']] + [record.get(col) for col in time_columns] for record in changes['records']))
+    conn.execute("INSERT OR REPLACE INTO sync_state (id, version) VALUES (1, ?)", (changes['version'],))
+    conn.commit()
+    print(f'Synced {len(changes["records"])} changed days ({len(response.content)} bytes).\nLocal cache: {cache_path(user)}\n\n')
+
+
+def print_totals(conn, since_date):
+    """Total door-to-door time, in plain Python so no heavy imports are needed"""
+    cursor = conn.execute("SELECT * FROM commute_logs WHERE date >= ?", (since_date,))
+    names = [column[0] for column in cursor.description]
+
+    total_seconds = 0
+    for row in cursor:
+        straight_home, durations = day_segments(dict(zip(names, row)))
+        for segment, _, _, seconds in durations:
+            if segment == 'door_to_door_out' or (segment == 'door_to_door_return' and straight_home):
+                total_seconds += seconds
+
+    total_time_commuting = total_seconds / 60
+    hours = int(total_time_commuting // 60)
+    minutes = int(total_time_commuting % 60)
+    period = f" since {since_date}" if since_date else ""
+    print(f"Total time spent commuting{period}: {hours}h {minutes}m\n(excluding days when I didn't come straight home)\n\n")
+
+
+def draw_plots(conn, since_date, plots, workers=None, force=False):
+    """Draw the chosen kinds of plot, importing the plotting libraries only now"""
+    from commute_analysis import load_commute_data
+    from commute_plots import plot_violin, plot_totals, plot_calplot, render_all
+
+    # Get values from the database, ignoring days where there was zero activity (in which every column contains a NULL)
+    query = f"""
+    SELECT date, {', '.join(time_columns)}
+    FROM commute_logs
+    WHERE date >= ? AND NOT (
+        left_home IS NULL AND
+        boarded_train_out IS NULL AND
+        alighted_train_out IS NULL AND
+        boarded_tube_out IS NULL AND
+        alighted_tube_out IS NULL AND
+        arrived_at_scale_space IS NULL AND
+        left_scale_space IS NULL AND
+        boarded_tube_return IS NULL
     )
-    
-    plt.title(f'{activity.capitalize()} Duration Distribution (Out vs Return)', fontsize=14, fontweight='bold')
-    plt.xticks([])  # Remove x-axis tick labels
-    plt.xlabel('')  # Remove x-axis label
-    plt.ylabel('Duration (minutes)', fontsize=12)
-    plt.legend(title='Direction', loc='upper right')
-    plt.tight_layout()
-
-    plt.savefig(f'{activity}_duration_distribution.png', dpi=300, bbox_inches='tight')
-
-
-
-# Bar plot of total duration by activity (excluding door2door)
-activity_totals = durations[durations['activity'] != 'door2door'].groupby("activity")["duration"].sum().reset_index()
-plt.figure(figsize=(10, 6))
-sns.barplot(data=activity_totals, x='activity', y='duration')
-plt.title('Total Duration by Activity')
-plt.ylabel('Total Duration (minutes)')
-plt.xlabel('')
-plt.tight_layout()
-plt.savefig('total_duration_by_activity.png', dpi=300, bbox_inches='tight')
-
-
-
-df.set_index("date", inplace=True)
-
-fig, ax = calplot.calplot(df.door_to_door_out,
-                          vmin=60,
-                          vmax=90,
-                          dropzero=True,
-                          linewidth=0.2,
-                          cmap="plasma",
-                          yearlabel_kws={'fontname':'sans-serif'},
-                          suptitle='Door-to-door time, in minutes, commuting to work');
-fig.savefig("calplot_out", dpi=300, bbox_inches='tight')
-
-fig, ax = calplot.calplot(df.loc[df['straight_home'] == True].door_to_door_return,
-                          vmin=60,
-                          vmax=90,
-                          dropzero=True,
-                          linewidth=0.2,
-                          cmap="plasma",
-                          yearlabel_kws={'fontname':'sans-serif'},
-                          suptitle='Door-to-door time, in minutes, returning home');
-fig.savefig("calplot_return", dpi=300, bbox_inches='tight')
-
-print("Plots created.")
+    """
+
+    # Read in chunks, each turned straight into compact columns: per-day door-to-door
+    # times and whether I came straight home (took the tube and didn't go out in Reading),
+    # and one long frame of date/duration/activity/direction for plotting, with a row
+    # per segment of the journey (see SEGMENTS in commute_segments.py)
+    days, durations = load_commute_data(conn, query, params=(since_date,))
+
+    # One plot job per figure. Each job only gets the data for its own figure, and
+    # the jobs are drawn in parallel across the CPU cores. The last argument is the file.
+    jobs = []
+
+    if 'violin' in plots:
+        # Separate figures for each activity
+        for activity in durations['activity'].unique():
+            activity_data = durations[durations['activity'] == activity]
+            jobs.append((plot_violin, (activity_data, activity, f'{activity}_duration_distribution.png')))
+
+    if 'bar' in plots:
+        # Bar plot of total duration by activity (excluding door2door)
+        activity_totals = durations[durations['activity'] != 'door2door'].groupby("activity", observed=True)["duration"].sum().reset_index()
+        activity_totals['activity'] = activity_totals['activity'].cat.remove_unused_categories()
+        if len(activity_totals):
+            jobs.append((plot_totals, (activity_totals, 'total_duration_by_activity.png')))
+
+    if 'calplot' in plots:
+        days = days.set_index('date')
+
+        # Days without a door-to-door time are left out, so they can't change the
+        # figure's hash (or add an empty year to the calendar). calplot can't draw
+        # an empty calendar, which a short --since range can give.
+        door_to_door_out = days.door_to_door_out.dropna()
+        if len(door_to_door_out):
+            jobs.append((plot_calplot, (door_to_door_out,
+                                        'Door-to-door time, in minutes, commuting to work',
+                                        'calplot_out.png')))
+        door_to_door_return = days.loc[days['straight_home']].door_to_door_return.dropna()
+        if len(door_to_door_return):
+            jobs.append((plot_calplot, (door_to_door_return,
+                                        'Door-to-door time, in minutes, returning home',
+                                        'calplot_return.png')))
+
+    # Figures whose data hasn't changed since the last run are skipped
+    written = render_all(jobs, workers=workers, force=force)
+
+    print(f"Plots created: {len(written)} redrawn, {len(jobs) - len(written)} unchanged.")
+
+
+def parse_since(value):
+    """--since accepts YYYY-MM-DD, or week/month/year for the start of the current one"""
+    today = date.today()
+    starts = {
+        'week': today - timedelta(days=today.weekday()),
+        'month': today.replace(day=1),
+        'year': today.replace(month=1, day=1),
+    }
+    if value in starts:
+        return starts[value].isoformat()
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not YYYY-MM-DD, week, month or year")
+
+
+def parse_plots(value):
+    plots = [kind.strip() for kind in value.split(',') if kind.strip()]
+    unknown = set(plots) - set(PLOT_KINDS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown plot kinds {sorted(unknown)}; choose from {', '.join(PLOT_KINDS)}")
+    return plots
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Commute totals and plots from CommuteTrackr')
+    parser.add_argument('--totals-only', action='store_true', help='print totals and skip the plots')
+    parser.add_argument('--plots', type=parse_plots, default=PLOT_KINDS,
+                        help=f"comma-separated plots to draw (default: {','.join(PLOT_KINDS)})")
+    parser.add_argument('--since', type=parse_since, default=None,
+                        help='only use days from YYYY-MM-DD, or the start of this week/month/year')
+    parser.add_argument('--no-sync', action='store_true', help="use the local copy without contacting the server")
+    parser.add_argument('--workers', type=int, default=None, help='processes for drawing plots (default: one per core)')
+    parser.add_argument('--force', action='store_true', help='redraw plots even if their data is unchanged')
+    parser.add_argument('--user', help="whose commute to use, if not the original user's")
+    args = parser.parse_args(argv)
+
+    conn = open_local_cache(args.user)
+    try:
+        if not args.no_sync:
+            sync_local_cache(conn, args.user)
+
+        since_date = args.since or ''
+        print_totals(conn, since_date)
+
+        if not args.totals_only and args.plots:
+            draw_plots(conn, since_date, args.plots, workers=args.workers, force=args.force)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#! python3
+# Micro-benchmarks for the visualiser's data preparation, on synthetic commute histories:
+#   python commute_visualisr_bench.py --years 1 5 10
+#   python commute_visualisr_bench.py --memory --years 10 40 160
+# --memory compares peak memory of reading the whole table at once with load_commute_data.
+
+import argparse
+import sqlite3
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from commute_analysis import SEGMENTS, STRAIGHT_HOME_LIMIT, time_columns, load_commute_data
+
+# Rough minutes between consecutive checkpoints, in the order they happen each day
+OUT_LEGS = [('left_home', 0), ('arrived_at_station', 13), ('boarded_train_out', 7),
+            ('alighted_train_out', 27), ('boarded_tube_out', 9), ('alighted_tube_out', 31),
+            ('arrived_at_scale_space', 7)]
+RETURN_LEGS = [('left_scale_space', 0), ('boarded_tube_return', 9), ('alighted_tube_return', 26),
+               ('boarded_train_return', 8), ('alighted_train_return', 29), ('left_station', 5),
+               ('arrived_at_home', 14)]
+
+
+def synthetic_logs(years, seed=0, missing=0.05):
+    """A commute_logs frame (as read_sql_query returns it) covering every weekday for some years"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2020-01-01', periods=int(years * 261))
+    df = pd.DataFrame({'date': dates.strftime('%Y-%m-%d')})
+
+    for legs, start in ((OUT_LEGS, 7 * 3600), (RETURN_LEGS, 17 * 3600)):
+        seconds = start + rng.integers(0, 3600, len(df))
+        for col, minutes in legs:
+            seconds = seconds + minutes * 60 + rng.integers(0, 240, len(df))
+            text = pd.Series(pd.to_timedelta(seconds, unit='s')).astype(str).str[-8:]
+            df[col] = text.where(rng.random(len(df)) > missing, None)
+
+    return df[['date'] + time_columns]
+
+
+def parse_checkpoint_times(dates, times):
+    """Turn a block of HH:MM:SS strings into datetimes on each row's date, all in one go
+
+    dates is a datetime64 Series and times a DataFrame of time strings with the same
+    index. Missing, empty or malformed times come out as NaT. The whole block is
+    parsed as a single flat array, so the cost is one vectorised pass rather than
+    a Python-level loop per row and column.
+    """
+    flat = pd.Series(times.to_numpy(dtype=object).ravel()).replace('', None)
+    offsets = pd.to_timedelta(flat, errors='coerce').to_numpy().reshape(times.shape)
+    stamps = dates.to_numpy(dtype='datetime64[ns]')[:, None] + offsets
+    return pd.DataFrame(stamps, index=times.index, columns=[f'{col}_dt' for col in times.columns])
+
+
+def parse_row_by_row(df):
+    """The original loop: one df.apply per column, parsing one row at a time"""
+    out = {}
+    for col in time_columns:
+        out[f'{col}_dt'] = df.apply(lambda row:
+            pd.to_datetime(str(row['date'].date()) + ' ' + row[col])
+            if pd.notna(row[col]) and row[col] != '' else pd.NaT, axis=1)
+    return pd.DataFrame(out)
+
+
+def parse_vectorised(df):
+    return parse_checkpoint_times(df['date'], df[time_columns])
+
+
+def load_whole_table(conn):
+    """The original loader: every column as strings, datetimes and float64 minutes side by side"""
+    df = pd.read_sql_query('SELECT * FROM commute_logs', conn)
+    df['date'] = pd.to_datetime(df['date'])
+    df = pd.concat([df, parse_checkpoint_times(df['date'], df[time_columns])], axis=1)
+    for segment, legs, *_ in SEGMENTS:
+        df[segment] = sum((df[f'{end}_dt'] - df[f'{start}_dt']).dt.total_seconds() / 60 for start, end in legs)
+    df['straight_home'] = (df['boarded_tube_return'].notnull() & df['alighted_tube_return'].notnull()
+                           & ~(df['door_to_door_return'] > STRAIGHT_HOME_LIMIT))
+    pieces = []
+    for segment, _, activity, direction, straight_home_only in SEGMENTS:
+        rows = df[df['straight_home']] if straight_home_only else df
+        pieces.append(pd.DataFrame({'date': rows['date'], 'duration': rows[segment],
+                                    'activity': activity, 'direction': direction}).dropna())
+    return df, pd.concat(pieces, ignore_index=True)
+
+
+def peak_megabytes(func, *args):
+    """Most memory allocated at once while func runs, and what it returned"""
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6, result
+
+
+def compare_memory(years_list):
+    print(f"{'years':>6}{'rows':>9}{'whole table MB':>16}{'streaming MB':>14}{'results MB':>12}")
+    for years in years_list:
+        conn = sqlite3.connect(':memory:')
+        synthetic_logs(years).to_sql('commute_logs', conn, index=False)
+
+        whole, (_, expected) = peak_megabytes(load_whole_table, conn)
+        streaming, (days, durations) = peak_megabytes(load_commute_data, conn, 'SELECT * FROM commute_logs')
+        assert len(durations) == len(expected)
+        results = (days.memory_usage(deep=True).sum() + durations.memory_usage(deep=True).sum()) / 1e6
+        print(f'{years:>6g}{len(days):>9}{whole:>16.1f}{streaming:>14.1f}{results:>12.1f}')
+        conn.close()
+
+
+def best_of(repeats, func, *args):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark checkpoint-time parsing in the visualiser')
+    parser.add_argument('--years', type=float, nargs='+', default=[1, 5, 10], help='history lengths to test')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--memory', action='store_true', help='compare peak memory of the loaders instead')
+    args = parser.parse_args()
+
+    if args.memory:
+        compare_memory(args.years)
+        return
+
+    print(f"{'years':>6}{'rows':>8}{'row-by-row s':>15}{'vectorised s':>15}{'speed-up':>10}")
+    for years in args.years:
+        df = synthetic_logs(years)
+        df['date'] = pd.to_datetime(df['date'])
+
+        slow, expected = best_of(1, parse_row_by_row, df)
+        fast, result = best_of(args.repeats, parse_vectorised, df)
+        pd.testing.assert_frame_equal(result, expected.astype('datetime64[ns]'))
+
+        print(f'{years:>6g}{len(df):>8}{slow:>15.3f}{fast:>15.4f}{slow / fast:>9.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,103 +1,230 @@
-from flask import Flask, render_template, request, jsonify
-import sqlite3
+from flask import Flask, render_template, request, jsonify, send_file, g
 import os
-from datetime import datetime, date
+import gzip
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime, date, timedelta
 import logging
 from contextlib import contextmanager
+try:
+    import brotli   # optional: pip install brotli for a smaller page than gzip
+except ImportError:
+    brotli = None
+from commutetrackr_db import get_pool, write_snapshot
+from commutetrackr_logging import configure_logging
+from commutetrackr_cache import get_record_cache
+from commutetrackr_metrics import render_metrics, request_duration, request_sql, requests_total, start_request_sql
+from commutetrackr_queries import (DEFAULT_USER_ID, EXTERNAL_ACTIVITIES, apply_events, estimate_arrival,
+                                  get_changed_records, get_record, get_summary, load_leg_stats, load_users,
+                                  log_checkpoints, log_many_days)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.ERROR,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/home/pi/ftp/files/commutetrackr.log'),
-        logging.StreamHandler()
-    ]
-)
+# Paths can be overridden (e.g. for benchmarks) without editing the deployed script
+LOG_PATH = os.environ.get('COMMUTETRACKR_LOG', '/home/pi/ftp/files/commutetrackr.log')
+
+# Logging goes through a queue to a background thread (see commutetrackr_logging.py)
+configure_logging(LOG_PATH)
 logger = logging.getLogger(__name__)
 
+# Requests slower than this many milliseconds are logged with their SQL time, even
+# when the log level is ERROR. Off unless set, e.g. COMMUTETRACKR_SLOW_REQUEST_MS=200
+SLOW_REQUEST_MS = float(os.environ.get('COMMUTETRACKR_SLOW_REQUEST_MS', 0))
+slow_logger = logging.getLogger(f'{__name__}.slow')
+slow_logger.setLevel(logging.WARNING)
+
 app = Flask(__name__)
 
 # Database configuration
-DATABASE_PATH = '/home/pi/ftp/files/commutetrackr.db'
+DATABASE_PATH = os.environ.get('COMMUTETRACKR_DATABASE', '/home/pi/ftp/files/commutetrackr.db')
+
+# Where /api/snapshot keeps the latest compressed copy of the database
+SNAPSHOT_PATH = os.environ.get('COMMUTETRACKR_SNAPSHOT',
+                               os.path.join(os.path.dirname(DATABASE_PATH), 'commutetrackr_snapshot.db.gz'))
+
+# The page is a static shell (no template variables) that fetches today's times from
+# /api/today itself. It's compressed once, not on every load, and phones keep it for a
+# day, showing the cached copy straight away while checking for a new one for a week.
+INDEX_PATH = os.path.join(app.root_path, 'templates', 'commutetrackr.html')
+INDEX_CACHE_CONTROL = 'public, max-age=86400, stale-while-revalidate=604800'
+
+# One connection per mod_wsgi thread (see threads=5 in 000-default.conf)
+POOL_SIZE = 5
+
+# Long-poll settings for /api/today/changes. Each waiting request holds a mod_wsgi
+# thread, so only a few may wait at once, leaving the rest free for button presses.
+LONG_POLL_TIMEOUT = 25      # seconds before answering 304 Not Modified
+LONG_POLL_RECHECK = 5       # seconds between checks for writes from other processes
+MAX_LONG_POLLS = POOL_SIZE - 2
+
+# Woken by every write in this process so waiting long-polls answer straight away
+today_changed = threading.Condition()
+
+# Limits for queued taps sent to /log_activity/batch
+MAX_BATCH_EVENTS = 100
+MAX_CLOCK_SKEW = timedelta(minutes=5)   # how far in the future a phone's clock may be
+MAX_QUEUED_AGE = timedelta(days=7)      # how long a tap may sit in a phone's queue
 
+# Most days accepted by one /api/log_external/bulk request (a year's worth)
+MAX_BULK_DAYS = 366
+long_poll_slots = threading.BoundedSemaphore(MAX_LONG_POLLS)
+
+# Endpoints that aren't anyone's in particular. Everything else is for the user named
+# by ?user=, or the original user if there isn't one.
+SHARED_ENDPOINTS = {'index', 'get_snapshot', 'metrics', 'static'}
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    start_request_sql()
+
+@app.after_request
+def record_request_metrics(response):
+    """Latency and status for /metrics, and the slow-request log"""
+    start = g.get('request_start')
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    # The URL rule rather than the path, so there's one series per endpoint
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_duration.observe((endpoint, request.method), elapsed)
+    requests_total.inc((endpoint, request.method, str(response.status_code)))
+    
+    # Long-polls are slow on purpose
+    if SLOW_REQUEST_MS and elapsed * 1000 > SLOW_REQUEST_MS and endpoint != '/api/today/changes':
+        statements, sql_seconds = request_sql()
+        slow_logger.warning("Slow request: %s %s -> %s in %.0f ms (%s SQL statements, %.0f ms)",
+                            request.method, request.full_path.rstrip('?'), response.status_code,
+                            elapsed * 1000, statements, sql_seconds * 1000)
+    return response
+
+@app.before_request
+def load_user():
+    """Look up the request's user (and their route) in the cached users table"""
+    if request.endpoint is None or request.endpoint in SHARED_ENDPOINTS:
+        return None
+    name = request.args.get('user')
+    users = get_users()
+    if name:
+        g.user = users.get(name)
+    else:
+        g.user = next((user for user in users.values() if user.id == DEFAULT_USER_ID), None)
+    if g.user is None:
+        return jsonify({'success': False, 'error': f'Unknown user: {name}'}), 404
+    return None
 
 @contextmanager
 def get_db_connection():
-    """Context manager for database connections"""
-    conn = None
+    """Context manager for pooled database connections"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        conn.row_factory = sqlite3.Row
-        yield conn
+        with get_pool(DATABASE_PATH, size=POOL_SIZE).connection() as conn:
+            yield conn
     except Exception as e:
-        if conn:
-            conn.rollback()
-        logger.error(f"Database error: {e}")
+        logger.error("Database error: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
 
-def get_or_create_today_record():
-    """Get today's record or create one if it doesn't exist"""
+def get_users():
+    """Every user by name, with their compiled route, reloaded only after a write"""
+    def load():
+        with get_db_connection() as conn:
+            return load_users(conn)
+    
+    return get_record_cache(DATABASE_PATH, 'users').get('all', load)
+
+def user_cache(name):
+    """The request's user's own record cache of a kind (the original user's keep their plain names)"""
+    if g.user.id != DEFAULT_USER_ID:
+        name = f'{name}:{g.user.name}'
+    return get_record_cache(DATABASE_PATH, name)
+
+def get_today_record():
+    """Get the user's record for today (all blanks if nothing has been logged yet)"""
     today = date.today().isoformat()
+    user_id = g.user.id
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Try to get today's record
-        cursor.execute('SELECT * FROM commute_logs WHERE date = ?', (today,))
-        record = cursor.fetchone()
-        
-        if record is None:
-            # Create new record for today
-            cursor.execute(
-                'INSERT INTO commute_logs (date) VALUES (?)',
-                (today,)
-            )
-            conn.commit()
-            
-            # Fetch the newly created record
-            cursor.execute('SELECT * FROM commute_logs WHERE date = ?', (today,))
-            record = cursor.fetchone()
-            
-        return dict(record)
+    def load():
+        with get_db_connection() as conn:
+            return get_record(conn, today, user_id)
+    
+    # Served from memory unless the database has changed or the day has rolled over
+    return user_cache('today').get(today, load)
 
-def update_commute_activity(activity_column, timestamp):
-    """Update a specific activity with timestamp if not already set"""
+def update_commute_activity(activity_column, timestamp, source='button'):
+    """Log an activity's timestamp for the user, returning whether it's the one that counts"""
     today = date.today().isoformat()
+    user = g.user
+    counted = set()
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Check if activity is already logged for today
-        cursor.execute(
-            f'SELECT {activity_column} FROM commute_logs WHERE date = ?',
-            (today,)
-        )
-        
-        result = cursor.fetchone()
-        if result and result[0] is not None:
-            return False  # Already logged
-        
-        # Update the record (removed updated_at column)
-        cursor.execute(
-            f'UPDATE commute_logs SET {activity_column} = ? WHERE date = ?',
-            (timestamp, today)
-        )
-        
-        conn.commit()
-        return True
+    def write():
+        with get_db_connection() as conn:
+            # Always appended; a tap on a checkpoint that's already logged just doesn't count
+            record, activities = log_checkpoints(conn, today, {activity_column: timestamp}, source, user)
+            conn.commit()
+            counted.update(activities)
+            return record
+    
+    user_cache('today').update(today, write)
+    success = activity_column in counted
+    
+    if success:
+        notify_today_changed()
+    return success
+
+def notify_today_changed():
+    """Wake any long-polls waiting on today's record"""
+    with today_changed:
+        today_changed.notify_all()
+
+def record_etag(record):
+    """Version of a record for ETags, changes whenever any of its values do"""
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode()).hexdigest()[:16]
+
+def today_response(record):
+    """JSON response for today's record that browsers revalidate by ETag"""
+    response = jsonify(record)
+    response.set_etag(record_etag(record))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+_index_shell = None
+_index_shell_lock = threading.Lock()
+
+def get_index_shell():
+    """The page's bytes in each encoding, plus an ETag, rebuilt only if the file changes"""
+    global _index_shell
+    stat = os.stat(INDEX_PATH)
+    key = (stat.st_mtime_ns, stat.st_size)
+    shell = _index_shell
+    if shell is None or shell['key'] != key:
+        with _index_shell_lock:
+            if _index_shell is None or _index_shell['key'] != key:
+                with open(INDEX_PATH, 'rb') as f:
+                    body = f.read()
+                variants = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+                if brotli is not None:
+                    variants['br'] = brotli.compress(body, quality=11)
+                _index_shell = {'key': key, 'etag': hashlib.sha256(body).hexdigest()[:16], 'variants': variants}
+            shell = _index_shell
+    return shell
 
 @app.route('/')
 def index():
-    """Main page with commute tracking buttons"""
+    """Main page with commute tracking buttons, which fetches today's times itself"""
     try:
-        record = get_or_create_today_record()
-        return render_template('commutetrackr.html', record=record)
+        shell = get_index_shell()
+        encoding = next((name for name in ('br', 'gzip')
+                         if name in shell['variants'] and request.accept_encodings.quality(name) > 0), 'identity')
+        response = app.response_class(shell['variants'][encoding], mimetype='text/html')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = INDEX_CACHE_CONTROL
+        # Each encoding is different bytes, so it gets its own ETag
+        response.set_etag(f"{shell['etag']}-{encoding}")
+        return response.make_conditional(request)
     except Exception as e:
-        logger.error(f"Error loading main page: {e}")
+        logger.error("Error loading main page: %s", e)
         return "Error loading page", 500
 
 @app.route('/log_activity', methods=['POST'])
@@ -106,36 +233,113 @@ def log_activity():
     try:
         data = request.get_json()
         activity = data.get('activity')
+        correction = bool(data.get('correction'))
         
         if not activity:
             return jsonify({'success': False, 'error': 'Activity not specified'}), 400
         
-        # Validate activity
-        valid_activities = [
-            'boarded_train_out', 'alighted_train_out', 'boarded_tube_out',
-            'alighted_tube_out', 'arrived_at_scale_space', 'left_scale_space',
-            'boarded_tube_return', 'alighted_tube_return', 'boarded_train_return',
-            'alighted_train_return'
-        ]
-        
-        if activity not in valid_activities:
+        # Validate activity against the user's route. Any checkpoint can be corrected, not just the buttons.
+        if activity not in (g.user.route.activities if correction else g.user.route.buttons):
             return jsonify({'success': False, 'error': 'Invalid activity'}), 400
         
         timestamp = datetime.now().strftime('%H:%M:%S')
-        success = update_commute_activity(activity, timestamp)
+        if correction and data.get('time'):
+            # A correction replaces whatever was logged, e.g. a button pressed at the wrong stop
+            try:
+                timestamp = datetime.strptime(data['time'], '%H:%M:%S').strftime('%H:%M:%S')
+            except (TypeError, ValueError):
+                return jsonify({'success': False, 'error': 'Invalid time format. Use HH:MM:SS'}), 400
+        
+        success = update_commute_activity(activity, timestamp, 'correction' if correction else 'button')
         
         if success:
-            logger.info(f"Logged activity: {activity} at {timestamp}")
+            logger.info("Logged activity: %s at %s", activity, timestamp)
             return jsonify({'success': True, 'timestamp': timestamp})
         else:
             return jsonify({'success': False, 'error': 'Activity already logged today'})
         
     except Exception as e:
-        logger.error(f"Error logging activity: {e}")
+        logger.error("Error logging activity: %s", e)
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
 
 
+def parse_client_event(event, route):
+    """Validate one queued tap, returning (event_id, day, activity, time) or an error message"""
+    if not isinstance(event, dict):
+        return 'Event must be an object'
+    
+    event_id = event.get('event_id')
+    activity = event.get('activity')
+    client_timestamp = event.get('client_timestamp')
+    
+    if not isinstance(event_id, str) or not event_id or len(event_id) > 64:
+        return 'Missing or invalid event_id'
+    if activity not in route.buttons:
+        return 'Invalid activity'
+    try:
+        tapped_at = datetime.fromisoformat(client_timestamp)
+        # A date on its own parses as midnight, which would log a time nobody tapped
+        if 'T' not in client_timestamp.upper() and ' ' not in client_timestamp:
+            raise ValueError(client_timestamp)
+    except (TypeError, ValueError):
+        return 'Invalid client_timestamp. Use ISO 8601, e.g. 2025-01-31T08:15:00'
+    
+    # Phones send local time; convert anything with an offset to the server's local time
+    if tapped_at.tzinfo is not None:
+        tapped_at = tapped_at.astimezone().replace(tzinfo=None)
+    if tapped_at > datetime.now() + MAX_CLOCK_SKEW:
+        return 'client_timestamp is in the future'
+    # Anything older was never a real queued tap (e.g. a corrupted localStorage entry),
+    # and would otherwise quietly rewrite a day long past
+    if tapped_at < datetime.now() - MAX_QUEUED_AGE:
+        return f'client_timestamp is more than {MAX_QUEUED_AGE.days} days old'
+    
+    return event_id, tapped_at.date().isoformat(), activity, tapped_at.strftime('%H:%M:%S')
+
+@app.route('/log_activity/batch', methods=['POST'])
+def log_activity_batch():
+    """Log taps queued by the page, using the time each button was actually pressed"""
+    try:
+        data = request.get_json(silent=True)
+        events = data.get('events') if isinstance(data, dict) else None
+        
+        if not isinstance(events, list) or not events:
+            return jsonify({'success': False, 'error': 'No events provided'}), 400
+        if len(events) > MAX_BATCH_EVENTS:
+            return jsonify({'success': False, 'error': f'At most {MAX_BATCH_EVENTS} events per batch'}), 400
+        
+        results = [None] * len(events)
+        valid = []
+        for index, event in enumerate(events):
+            parsed = parse_client_event(event, g.user.route)
+            if isinstance(parsed, str):
+                results[index] = {'event_id': event.get('event_id') if isinstance(event, dict) else None,
+                                  'status': 'invalid', 'error': parsed}
+            else:
+                valid.append((index, parsed))
+        
+        if valid:
+            # All events go in one transaction, and re-sent event_ids are ignored,
+            # so a retry after a dropped response can't log anything twice
+            with get_db_connection() as conn:
+                applied = apply_events(conn, [parsed for _, parsed in valid], g.user)
+                conn.commit()
+            
+            # The cache notices this commit through PRAGMA data_version
+            for (index, parsed), (status, logged_time) in zip(valid, applied):
+                results[index] = {'event_id': parsed[0], 'status': status, 'timestamp': logged_time}
+            
+            if any(result['status'] == 'logged' for result in results):
+                notify_today_changed()
+        
+        logger.info("Applied batch of %s events", len(events))
+        return jsonify({'success': True, 'results': results})
+    
+    except Exception as e:
+        logger.error("Error logging activity batch: %s", e)
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
 @app.route('/api/log_external', methods=['POST'])
 def log_external_activity():
     """API endpoint for external activity logging - Robust version"""
@@ -145,80 +349,288 @@ def log_external_activity():
         if not data:
             return jsonify({'success': False, 'error': 'No JSON data provided'}), 400
         
-        # Valid external activities
-        valid_external = ['left_home', 'arrived_at_station', 'left_station', 'arrived_at_home']
-        
         today = date.today().isoformat()
-        logged_activities = []
+        user = g.user
+        external = user.route.activities & EXTERNAL_ACTIVITIES
+        values = {}
         
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Ensure today's record exists using INSERT OR IGNORE
-            cursor.execute('INSERT OR IGNORE INTO commute_logs (date) VALUES (?)', (today,))
-            
-            # Process each activity individually
-            for key, value in data.items():
-                if key in valid_external and value:
-                    # Validate timestamp format
-                    try:
-                        datetime.strptime(value, '%H:%M:%S')
-                    except ValueError:
-                        return jsonify({
-                            'success': False, 
-                            'error': f'Invalid time format for {key}. Use HH:MM:SS'
-                        }), 400
-                    
-                    # Update individual field (removed updated_at column)
-                    update_query = f'UPDATE commute_logs SET {key} = ? WHERE date = ?'
-                    cursor.execute(update_query, (value, today))
-                    
-                    rows_affected = cursor.rowcount
-                    logger.debug(f"Updated {key}: {rows_affected} rows affected")
-                    
-                    if rows_affected > 0:
-                        logged_activities.append(key)
-                    else:
-                        logger.error(f"Failed to update {key} - no rows affected")
+        for key, value in data.items():
+            if key in external and value:
+                # Validate timestamp format
+                try:
+                    datetime.strptime(value, '%H:%M:%S')
+                except ValueError:
+                    return jsonify({
+                        'success': False, 
+                        'error': f'Invalid time format for {key}. Use HH:MM:SS'
+                    }), 400
+                values[key] = value
+        
+        logged_activities = []
+        if values:
+            def write():
+                with get_db_connection() as conn:
+                    # External times replace anything logged before them
+                    record, _ = log_checkpoints(conn, today, values, source='external', user=user)
+                    conn.commit()
+                    return record
             
-            # Commit all changes
-            conn.commit()
+            record = user_cache('today').update(today, write)
+            notify_today_changed()
             
-            # Verify the updates
-            cursor.execute('SELECT * FROM commute_logs WHERE date = ?', (today,))
-            record = cursor.fetchone()
             if record:
-                logger.info(f"Final record state: {dict(record)}")
+                logged_activities = list(values)
+                logger.debug("Final record state: %s", record)
             
         if logged_activities:
-            logger.info(f"Successfully logged external activities: {logged_activities}")
+            logger.info("Successfully logged external activities: %s", logged_activities)
             return jsonify({'success': True, 'logged': logged_activities})
         else:
             return jsonify({'success': False, 'error': 'No activities were logged'})
         
     except Exception as e:
-        logger.error(f"Error logging external activity: {e}")
+        logger.error("Error logging external activity: %s", e)
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
     
     
 
+def parse_external_day(day, external):
+    """Validate one day of a bulk upload, returning (date, {activity: time}) or an error message"""
+    if not isinstance(day, dict):
+        return 'Each day must be an object'
+    
+    try:
+        day_date = date.fromisoformat(day.get('date'))
+    except (TypeError, ValueError):
+        return 'Missing or invalid date. Use YYYY-MM-DD'
+    if day_date > date.today():
+        return f'{day_date} is in the future'
+    
+    values = {}
+    for key, value in day.items():
+        if key in external and value:
+            try:
+                datetime.strptime(value, '%H:%M:%S')
+            except (TypeError, ValueError):
+                return f'Invalid time format for {key} on {day_date}. Use HH:MM:SS'
+            values[key] = value
+    return day_date.isoformat(), values
+
+@app.route('/api/log_external/bulk', methods=['POST'])
+def log_external_bulk():
+    """Log external activities for many days at once, e.g. a Strava backfill, in one transaction"""
+    try:
+        data = request.get_json(silent=True)
+        days = data.get('days') if isinstance(data, dict) else None
+        
+        if not isinstance(days, list) or not days:
+            return jsonify({'success': False, 'error': 'No days provided'}), 400
+        if len(days) > MAX_BULK_DAYS:
+            return jsonify({'success': False, 'error': f'At most {MAX_BULK_DAYS} days per request'}), 400
+        
+        # All or nothing, so a bad day can be fixed and the whole chunk resent
+        external = g.user.route.activities & EXTERNAL_ACTIVITIES
+        values_by_day = {}
+        for index, day in enumerate(days):
+            parsed = parse_external_day(day, external)
+            if isinstance(parsed, str):
+                return jsonify({'success': False, 'error': parsed, 'index': index}), 400
+            day_date, values = parsed
+            if values:
+                values_by_day.setdefault(day_date, {}).update(values)
+        
+        logged = 0
+        if values_by_day:
+            with get_db_connection() as conn:
+                logged = log_many_days(conn, values_by_day, user=g.user)
+                conn.commit()
+            
+            # The cache notices this commit through PRAGMA data_version
+            if date.today().isoformat() in values_by_day:
+                notify_today_changed()
+        
+        logger.info("Bulk logged %s external activities over %s days", logged, len(values_by_day))
+        return jsonify({'success': True, 'days': len(values_by_day), 'logged': logged})
+    
+    except Exception as e:
+        logger.error("Error bulk logging external activities: %s", e)
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
 @app.route('/api/today')
 def get_today_data():
     """API endpoint to get today's commute data"""
     try:
-        record = get_or_create_today_record()
-        return jsonify(record)
+        record = get_today_record()
+        return today_response(record).make_conditional(request)
+    except Exception as e:
+        logger.error("Error fetching today's data: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/today/changes')
+def wait_for_today_changes():
+    """Long-poll: answer as soon as today's record differs from the If-None-Match ETag"""
+    try:
+        known_etags = request.if_none_match
+        record = get_today_record()
+        
+        if not known_etags.contains(record_etag(record)):
+            return today_response(record)
+        
+        if not long_poll_slots.acquire(blocking=False):
+            # Too many waiters already; tell the client to come back later
+            response = app.response_class(status=304)
+            response.set_etag(record_etag(record))
+            response.headers['Retry-After'] = str(LONG_POLL_TIMEOUT)
+            return response
+        
+        try:
+            deadline = time.monotonic() + LONG_POLL_TIMEOUT
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                with today_changed:
+                    today_changed.wait(min(remaining, LONG_POLL_RECHECK))
+                record = get_today_record()
+                if not known_etags.contains(record_etag(record)):
+                    return today_response(record)
+        finally:
+            long_poll_slots.release()
+        
+        response = app.response_class(status=304)
+        response.set_etag(record_etag(record))
+        return response
+    except Exception as e:
+        logger.error("Error waiting for today's data: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/logs')
+def get_changed_logs():
+    """API endpoint for incremental sync: rows changed since a version and/or from a date on"""
+    try:
+        since_version = request.args.get('since_version', 0, type=int)
+        since_date = request.args.get('since_date', '')
+        
+        if since_date:
+            try:
+                date.fromisoformat(since_date)
+            except ValueError:
+                return jsonify({'error': 'Invalid since_date. Use YYYY-MM-DD'}), 400
+        
+        with get_db_connection() as conn:
+            version, records = get_changed_records(conn, since_version, since_date, g.user.id)
+        
+        return jsonify({'version': version, 'records': records})
     except Exception as e:
-        logger.error(f"Error fetching today's data: {e}")
+        logger.error("Error fetching changed logs: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/summary')
+def get_summary_data():
+    """API endpoint for commute stats worked out on the Pi, so nothing has to download the database"""
+    try:
+        since_date = request.args.get('since_date', '')
+        
+        if since_date:
+            try:
+                date.fromisoformat(since_date)
+            except ValueError:
+                return jsonify({'error': 'Invalid since_date. Use YYYY-MM-DD'}), 400
+        
+        def load():
+            with get_db_connection() as conn:
+                return get_summary(conn, since_date, g.user.id)
+        
+        # Recomputed only after something has been written
+        summary = user_cache('summary').get(since_date, load)
+        return jsonify(summary)
+    except Exception as e:
+        logger.error("Error building summary: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/route')
+def get_route():
+    """The user's route: its checkpoints in order, and which of them are buttons"""
+    route = g.user.route
+    return jsonify({'user': g.user.name, 'route': route.name, 'journeys': route.journeys,
+                    'buttons': [checkpoint for checkpoint in route.checkpoints if checkpoint in route.buttons]})
+
+@app.route('/api/eta')
+def get_eta():
+    """Likely arrival time at Scale Space or home, from today's checkpoints and how long each leg usually takes"""
+    try:
+        journey = request.args.get('journey')
+        journeys = g.user.route.journeys
+        if journey is not None and journey not in journeys:
+            return jsonify({'error': f"Invalid journey. Use one of: {', '.join(journeys)}"}), 400
+        
+        def load():
+            with get_db_connection() as conn:
+                return load_leg_stats(conn, g.user.id)
+        
+        # The leg stats are only reloaded after something has been written, so this
+        # is normally two cache hits and some arithmetic
+        stats = user_cache('leg_stats').get('all', load)
+        now = datetime.now()
+        seconds = now.hour * 3600 + now.minute * 60 + now.second
+        eta = estimate_arrival(stats, get_today_record(), int(now.strftime('%w')), seconds, journey, journeys)
+        response = jsonify(eta)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.error("Error estimating arrival: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+def open_snapshot():
+    """Open the current snapshot file, building it first if anything has been written since"""
+    cache = get_record_cache(DATABASE_PATH, 'snapshot')
+    
+    def load():
+        return write_snapshot(get_pool(DATABASE_PATH, size=POOL_SIZE), SNAPSHOT_PATH)
+    
+    for _ in range(3):
+        snapshot = cache.get(SNAPSHOT_PATH, load)
+        try:
+            f = open(SNAPSHOT_PATH, 'rb')
+        except FileNotFoundError:
+            cache.clear()
+            continue
+        # A write in between may have replaced the file since the checksum was read
+        if os.fstat(f.fileno()).st_ino == snapshot['inode']:
+            return snapshot, f
+        f.close()
+        # The cached checksum is for a file that's gone, so build (or re-read) it again
+        cache.clear()
+    raise RuntimeError('Snapshot kept changing while being opened')
+
+@app.route('/api/snapshot')
+def get_snapshot():
+    """Consistent gzipped copy of the whole database, only rebuilt after something has been written"""
+    try:
+        snapshot, f = open_snapshot()
+        response = send_file(f, mimetype='application/gzip', as_attachment=True, download_name='commutetrackr.db.gz',
+                             etag=snapshot['sha256'], max_age=0, conditional=False)
+        response.headers['X-Checksum-SHA256'] = snapshot['sha256']
+        response.headers['X-Uncompressed-Size'] = str(snapshot['uncompressed_size'])
+        # send_file can't size an open file, so it's passed in for Content-Length and Range requests
+        response.content_length = snapshot['size']
+        return response.make_conditional(request, accept_ranges=True, complete_length=snapshot['size'])
+    except Exception as e:
+        logger.error("Error serving snapshot: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/metrics')
+def metrics():
+    """Request latencies, SQL timings and cache hit counts in the Prometheus text format"""
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
 @app.errorhandler(500)
 def internal_error(error):
-    logger.error(f"Internal server error: {error}")
+    logger.error("Internal server error: %s", error)
     return render_template('500.html'), 500
 
 # after changing python script you must execute: sudo systemctl reload apache2
\ No newline at end of file
@@ -0,0 +1,358 @@
+#! python3
+# Benchmarks for the CommuteTrackr endpoints, always run against a throwaway database.
+#
+# latency: one request at a time, comparing the old open-a-connection-per-call
+# approach (which had no record cache either) with the pooled WAL connections:
+#   python commutetrackr_bench.py latency --requests 500
+#
+# load: a realistic mix of traffic for a fixed time, through the same 5-thread limit
+# as mod_wsgi. Tabs poll /api/today with ETags, buttons are tapped in bursts, Strava
+# posts to /api/log_external and the visualiser syncs. Reports throughput and
+# p50/p95/p99 per endpoint. --writers adds processes that hold write transactions
+# open on the same file, to show what "database is locked" contention does:
+#   python commutetrackr_bench.py load --duration 20 --tabs 20
+#   python commutetrackr_bench.py load --writers 2 --hold-ms 200 --json after.json
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+# The app reads these at import time, so point them somewhere harmless first
+BENCH_DIR = tempfile.mkdtemp(prefix='commutetrackr_bench_')
+os.environ.setdefault('COMMUTETRACKR_LOG', os.path.join(BENCH_DIR, 'commutetrackr.log'))
+os.environ.setdefault('COMMUTETRACKR_ENV', 'benchmark')
+
+import commutetrackr_app
+from commutetrackr_cache import get_record_cache
+from commutetrackr_db import create_schema, get_pool
+from commutetrackr_queries import BUTTON_ACTIVITIES, log_many_days
+
+original_get_db_connection = commutetrackr_app.get_db_connection
+
+
+@contextmanager
+def per_call_connection():
+    """The pre-pool get_db_connection: a fresh rollback-journal connection every call"""
+    conn = sqlite3.connect(commutetrackr_app.DATABASE_PATH)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def time_endpoint(client, n, call, before_each=None):
+    samples = []
+    for _ in range(n):
+        if before_each:
+            before_each()
+        start = time.perf_counter()
+        response = call(client)
+        samples.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.status_code
+    return samples
+
+
+def run_mode(mode, n):
+    db_path = os.path.join(BENCH_DIR, f'{mode}.db')
+    create_schema(db_path)
+    commutetrackr_app.DATABASE_PATH = db_path
+    commutetrackr_app.get_db_connection = per_call_connection if mode == 'per-call' else original_get_db_connection
+    
+    def forget_cached_records():
+        # Before the pool, every request read its record (and now its user) from the file
+        for name in ('today', 'users'):
+            get_record_cache(db_path, name).clear()
+
+    client = commutetrackr_app.app.test_client()
+    endpoints = {
+        'GET /': (lambda c: c.get('/'), None),
+        'GET /api/today': (lambda c: c.get('/api/today'), None),
+        # Every tap is appended to commute_events, though repeats don't rewrite the segments
+        'POST /log_activity': (
+            lambda c: c.post('/log_activity', json={'activity': 'boarded_train_out'}),
+            None,
+        ),
+        'POST /api/log_external': (
+            lambda c: c.post('/api/log_external', json={'left_home': '07:01:02', 'arrived_at_station': '07:15:00'}),
+            None,
+        ),
+    }
+
+    results = {}
+    for name, (call, before_each) in endpoints.items():
+        if mode == 'per-call':
+            def before_each(setup=before_each):
+                forget_cached_records()
+                if setup:
+                    setup()
+        time_endpoint(client, 5, call, before_each)  # warm up
+        results[name] = time_endpoint(client, n, call, before_each)
+    return results
+
+
+def run_latency(args):
+    print(f"{'endpoint':<26}{'mode':<10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    all_results = {mode: run_mode(mode, args.requests) for mode in ('per-call', 'pooled')}
+    for name in all_results['pooled']:
+        for mode, results in all_results.items():
+            samples = results[name]
+            print(f'{name:<26}{mode:<10}{statistics.mean(samples):>10.3f}'
+                  f'{percentile(samples, 50):>10.3f}{percentile(samples, 95):>10.3f}')
+
+
+def seed_history(db_path, days, rng):
+    """Fill a new database with a plausible history of weekday commutes, ending yesterday"""
+    history = {}
+    day = date.today() - timedelta(days=days)
+    while day < date.today():
+        if day.weekday() < 5:
+            minute = rng.randint(0, 20)
+            history[day.isoformat()] = {
+                'left_home': f'07:{minute:02d}:00', 'arrived_at_station': f'07:{minute + 14:02d}:00',
+                'boarded_train_out': f'07:{minute + 20:02d}:00', 'alighted_train_out': f'07:{minute + 45:02d}:00',
+                'left_scale_space': f'17:{minute:02d}:00', 'left_station': f'18:{minute:02d}:00',
+                'arrived_at_home': f'18:{minute + 15:02d}:00',
+            }
+        day += timedelta(days=1)
+    with get_pool(db_path).connection() as conn:
+        log_many_days(conn, history)
+        conn.commit()
+
+
+class ThreadLimit:
+    """WSGI middleware letting only so many requests run at once, like mod_wsgi's threads=5
+
+    Waiting for a thread counts towards a request's latency, as it would for a phone.
+    """
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def __call__(self, environ, start_response):
+        with self.slots:
+            return list(self.app(environ, start_response))
+
+
+class Recorder:
+    """Latency samples and error counts per endpoint, shared by every traffic thread"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def call(self, name, send):
+        start = time.perf_counter()
+        try:
+            response = send()
+            failed = response.status_code >= 500
+        except Exception:
+            response, failed = None, True
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.samples.setdefault(name, []).append(elapsed)
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        return response
+
+
+def polling_tab(recorder, stop, interval, rng):
+    """A phone with the page open, revalidating today's record with its ETag like the page does"""
+    client = commutetrackr_app.app.test_client()
+    etag = None
+    while not stop.is_set():
+        headers = {'If-None-Match': etag} if etag else {}
+        response = recorder.call('GET /api/today', lambda: client.get('/api/today', headers=headers))
+        if response is not None and response.status_code == 200:
+            etag = response.headers.get('ETag')
+        stop.wait(interval * rng.uniform(0.5, 1.5))
+
+
+def tapping(recorder, stop, interval, burst, rng):
+    """Bursts of button taps, e.g. getting off one train and straight onto the tube"""
+    client = commutetrackr_app.app.test_client()
+    activities = sorted(BUTTON_ACTIVITIES)
+    while not stop.wait(interval * rng.uniform(0.5, 1.5)):
+        for _ in range(burst):
+            activity = rng.choice(activities)
+            recorder.call('POST /log_activity', lambda: client.post('/log_activity', json={'activity': activity}))
+
+
+def strava(recorder, stop, interval, rng):
+    """The inserter's nightly POST, at a much faster rate"""
+    client = commutetrackr_app.app.test_client()
+    while not stop.wait(interval * rng.uniform(0.5, 1.5)):
+        minute = rng.randint(0, 20)
+        times = {'left_home': f'07:{minute:02d}:00', 'arrived_at_station': f'07:{minute + 14:02d}:00',
+                 'left_station': f'18:{minute:02d}:00', 'arrived_at_home': f'18:{minute + 15:02d}:00'}
+        recorder.call('POST /api/log_external', lambda: client.post('/api/log_external', json=times))
+
+
+def visualiser(recorder, stop, interval, rng):
+    """The visualiser's delta sync, plus someone checking the summary"""
+    client = commutetrackr_app.app.test_client()
+    version = 0
+    while not stop.wait(interval * rng.uniform(0.5, 1.5)):
+        response = recorder.call('GET /api/logs', lambda: client.get('/api/logs', query_string={'since_version': version}))
+        if response is not None and response.status_code == 200:
+            version = response.get_json()['version']
+        recorder.call('GET /api/summary', lambda: client.get('/api/summary'))
+
+
+def contending_writer(db_path, stop, hold, results):
+    """Another process holding write transactions open on the database, e.g. the sqlite3 shell"""
+    conn = sqlite3.connect(db_path, timeout=5, isolation_level=None)
+    commits = locked = 0
+    while not stop.is_set():
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("INSERT INTO commute_events (date, activity, ts, source) "
+                         "VALUES ('2000-01-01', 'left_home', '07:00:00', 'correction')")
+            time.sleep(hold)
+            conn.execute('COMMIT')
+            commits += 1
+        except sqlite3.OperationalError:
+            locked += 1
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        time.sleep(0.01)
+    conn.close()
+    results.put((commits, locked))
+
+
+def run_load(args):
+    rng = random.Random(args.seed)
+    db_path = os.path.join(BENCH_DIR, 'load.db')
+    if args.database:
+        # A copy of a real database, taken consistently even if the app is using it
+        source = sqlite3.connect(args.database)
+        source.execute('VACUUM INTO ?', (db_path,))
+        source.close()
+        create_schema(db_path)
+    else:
+        create_schema(db_path)
+        seed_history(db_path, args.seed_days, rng)
+    commutetrackr_app.DATABASE_PATH = db_path
+
+    app = commutetrackr_app.app
+    original_wsgi_app = app.wsgi_app
+    app.wsgi_app = ThreadLimit(original_wsgi_app, args.wsgi_threads)
+
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = [threading.Thread(target=polling_tab, args=(recorder, stop, args.poll_interval, random.Random(rng.random())))
+               for _ in range(args.tabs)]
+    threads.append(threading.Thread(target=tapping, args=(recorder, stop, args.burst_interval, args.burst_size,
+                                                          random.Random(rng.random()))))
+    threads.append(threading.Thread(target=strava, args=(recorder, stop, args.external_interval,
+                                                         random.Random(rng.random()))))
+    threads.append(threading.Thread(target=visualiser, args=(recorder, stop, args.external_interval,
+                                                             random.Random(rng.random()))))
+
+    writer_stop = multiprocessing.Event()
+    writer_results = multiprocessing.Queue()
+    writers = [multiprocessing.Process(target=contending_writer,
+                                       args=(db_path, writer_stop, args.hold_ms / 1000, writer_results))
+               for _ in range(args.writers)]
+
+    for process in writers:
+        process.start()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    writer_stop.set()
+    writer_totals = [writer_results.get() for _ in writers]
+    for process in writers:
+        process.join()
+    app.wsgi_app = original_wsgi_app
+
+    report = {'duration_seconds': elapsed, 'endpoints': {}}
+    print(f"{'endpoint':<24}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, samples in sorted(recorder.samples.items()):
+        stats = {
+            'requests': len(samples),
+            'errors': recorder.errors.get(name, 0),
+            'throughput': len(samples) / elapsed,
+            'p50_ms': percentile(samples, 50),
+            'p95_ms': percentile(samples, 95),
+            'p99_ms': percentile(samples, 99),
+            'max_ms': max(samples),
+        }
+        report['endpoints'][name] = stats
+        print(f"{name:<24}{stats['requests']:>9}{stats['errors']:>8}{stats['throughput']:>9.1f}{stats['p50_ms']:>9.2f}"
+              f"{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}{stats['max_ms']:>9.2f}")
+    total = sum(len(samples) for samples in recorder.samples.values())
+    print(f'\n{total} requests in {elapsed:.1f} s ({total / elapsed:.1f} req/s)')
+
+    if writers:
+        commits = sum(result[0] for result in writer_totals)
+        locked = sum(result[1] for result in writer_totals)
+        report['contending_writers'] = {'writers': len(writers), 'hold_ms': args.hold_ms,
+                                        'commits': commits, 'locked': locked}
+        print(f'{len(writers)} contending writers holding locks for {args.hold_ms} ms: '
+              f'{commits} commits, {locked} gave up on "database is locked"')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f'Results written to {args.json}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CommuteTrackr endpoints against a throwaway database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    latency = commands.add_parser('latency', help='one request at a time, per-call connections vs the pool')
+    latency.add_argument('--requests', type=int, default=200, help='requests per endpoint per mode')
+
+    load = commands.add_parser('load', help='concurrent, realistic traffic for a fixed time')
+    load.add_argument('--duration', type=float, default=10, help='seconds to run for')
+    load.add_argument('--tabs', type=int, default=10, help='open pages polling /api/today')
+    load.add_argument('--poll-interval', type=float, default=1.0, help='seconds between each tab\'s polls')
+    load.add_argument('--burst-size', type=int, default=5, help='taps per burst of /log_activity')
+    load.add_argument('--burst-interval', type=float, default=2.0, help='seconds between bursts')
+    load.add_argument('--external-interval', type=float, default=5.0,
+                      help='seconds between /api/log_external posts (and visualiser syncs)')
+    load.add_argument('--wsgi-threads', type=int, default=5, help='requests handled at once, as in 000-default.conf')
+    load.add_argument('--writers', type=int, default=0, help='extra processes contending for the write lock')
+    load.add_argument('--hold-ms', type=float, default=100, help='how long each contending write transaction lasts')
+    load.add_argument('--database', help='copy this database instead of generating a history')
+    load.add_argument('--seed-days', type=int, default=365, help='days of generated history')
+    load.add_argument('--seed', type=int, default=1, help='random seed, so runs can be compared')
+    load.add_argument('--json', help='also write the results to this file')
+
+    args = parser.parse_args(argv)
+    print(f'Benchmark database directory: {BENCH_DIR}\n')
+    if args.command == 'latency':
+        run_latency(args)
+    else:
+        run_load(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import threading
+
+
+class RecordCache:
+    """Process-local copy of one query result (e.g. today's row), kept in step with the database
+
+    Writes made through update() go straight into the cache. Anything else (another
+    process, the sqlite3 shell) is spotted with PRAGMA data_version on a connection of
+    our own, which changes whenever any other connection commits. In WAL mode that
+    check is answered from shared memory, so a cache hit never touches the SD card.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._watch = None
+        self._pid = None
+        self._day = None
+        self._record = None
+        self._version = None
+
+    def _data_version(self):
+        # Only ever used for PRAGMA data_version, never for reads or writes
+        if self._watch is None or self._pid != os.getpid():
+            self._watch = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._watch.execute('PRAGMA data_version').fetchone()[0]
+
+    def get(self, day, load):
+        """Return the record for a day (or other key), calling load() if the cached copy may be stale"""
+        with self._lock:
+            # Read the version before loading: a commit in between just means
+            # one extra reload next time, never a stale record being served
+            version = self._data_version()
+            if self._day == day and self._version == version:
+                self.hits += 1
+                return dict(self._record)
+
+            self.misses += 1
+            record = load()
+            self._day, self._record, self._version = day, record, version
+            return dict(record)
+
+    def update(self, day, write):
+        """Run write(), which commits and returns the new record (or None), and cache it"""
+        # Holding the lock through the write keeps this process's writes and the
+        # cache in the same order. The version is read before writing, as in get():
+        # our own commit then costs one extra reload, but a commit from another
+        # process between ours and the read can't be marked as already seen.
+        with self._lock:
+            version = self._data_version()
+            record = write()
+            if record is not None:
+                self._day, self._record, self._version = day, record, version
+            return record
+
+    def clear(self):
+        """Forget the cached record so the next get() reloads it"""
+        with self._lock:
+            self._day = self._record = self._version = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_record_cache(path, name='today'):
+    """Get a named process-wide record cache for a database file"""
+    cache = _caches.get((path, name))
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.setdefault((path, name), RecordCache(path))
+    return cache
+
+
+def cache_stats():
+    """(name, hits, misses) for every record cache in this process, for /metrics"""
+    with _caches_lock:
+        caches = list(_caches.items())
+    return [(name, cache.hits, cache.misses) for (_, name), cache in caches]
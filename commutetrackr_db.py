@@ -0,0 +1,536 @@
+import os
+import gzip
+import json
+import queue
+import shutil
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from commute_segments import JOURNEYS, time_columns
+from commutetrackr_metrics import TimedConnection
+from commutetrackr_queries import (DEFAULT_ROUTE_ID, DEFAULT_USER_ID, OVERRIDING_SOURCES, backfill_segments,
+                                  compile_route)
+
+# Pragmas applied to every pooled connection. WAL lets the polling readers carry
+# on while a button press is being written, and synchronous=NORMAL only fsyncs
+# at checkpoints rather than on every commit, which is what hurts on the SD card.
+PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -8000),        # negative means KiB, so 8 MB of page cache
+    ('mmap_size', 67108864),      # 64 MB, far bigger than the database will get
+    ('busy_timeout', 5000),       # milliseconds to wait on a locked database
+    ('temp_store', 'MEMORY'),
+]
+
+# How long a request waits for a free connection before giving up (seconds)
+ACQUIRE_TIMEOUT = 30
+
+
+class ConnectionPool:
+    """Pool of SQLite connections shared between the mod_wsgi threads of one process"""
+
+    def __init__(self, path, size=5, checkpoint_on_write=True):
+        self.path = path
+        self.size = size
+        # Apache serves commutetrackr.db as a static file, and a copy of the main file
+        # alone misses anything still sitting in the -wal file. A passive checkpoint
+        # after each write keeps the main file current without blocking readers, and
+        # only costs anything on the (rare) write requests. (/api/snapshot is the
+        # safe way to copy the database; see write_snapshot below.)
+        self.checkpoint_on_write = checkpoint_on_write
+        self._lock = threading.Lock()
+        # Held while the first connection sets up the schema, so threads opening
+        # connections at the same moment don't all run it at once
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._reset()
+
+    def _reset(self):
+        # Connections must never cross a fork, so a child process starts a fresh pool
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+
+    def _connect(self):
+        # Timed so /metrics can show where the database time goes
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        for name, value in PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    # Other processes are kept in step by each step's BEGIN IMMEDIATE
+                    migrate_single_user(conn)
+                    conn.executescript(SCHEMA)
+                    migrate_wide_table(conn)
+                    create_logs_view(conn)
+                    backfill_segments(conn)
+                    self._schema_ready = True
+        return conn
+
+    def acquire(self):
+        """Take an idle connection, opening a new one if the pool isn't full yet"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            can_open = self._created < self.size
+            if can_open:
+                self._created += 1
+
+        if can_open:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Timed out waiting for a database connection')
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, or close it if it can't be reused"""
+        if not discard:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                discard = True
+
+        if discard or self._pid != os.getpid():
+            conn.close()
+            with self._lock:
+                if self._pid == os.getpid():
+                    self._created -= 1
+            return
+
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that borrows a connection for the duration of the block"""
+        conn = self.acquire()
+        changes_before = conn.total_changes
+        discard = False
+        try:
+            yield conn
+            if self.checkpoint_on_write and conn.total_changes != changes_before:
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        except (sqlite3.InterfaceError, sqlite3.ProgrammingError):
+            discard = True
+            raise
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close(self):
+        """Close every idle connection (connections in use are closed on release)"""
+        with self._lock:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self._created -= 1
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path, size=5):
+    """Get the process-wide pool for a database file, creating it on first use"""
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = _pools[path] = ConnectionPool(path, size=size)
+    return pool
+
+
+def write_snapshot(pool, path):
+    """Write a gzipped, point-in-time copy of the pool's database to path
+
+    VACUUM INTO copies the database as of a single read transaction, so the copy
+    can't be torn by a write landing halfway through, and in WAL mode it doesn't
+    hold up the writers either. The connection goes back to the pool before the
+    (slower) compression starts. The finished file replaces path in one rename,
+    so anyone still reading the previous snapshot keeps their copy intact.
+    Returns the file's sha256 and sizes, and its inode to tell snapshots apart.
+    """
+    raw_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    gz_path = f'{raw_path}.gz'
+    try:
+        with pool.connection() as conn:
+            conn.execute('VACUUM INTO ?', (raw_path,))
+
+        digest = hashlib.sha256()
+        with open(raw_path, 'rb') as raw, open(gz_path, 'wb') as out:
+            # mtime=0 so the same database always compresses to the same bytes
+            with gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=0) as gz:
+                shutil.copyfileobj(raw, gz, 1024 * 1024)
+        with open(gz_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+
+        snapshot = {
+            'sha256': digest.hexdigest(),
+            'size': os.path.getsize(gz_path),
+            'uncompressed_size': os.path.getsize(raw_path),
+        }
+        os.replace(gz_path, path)
+        snapshot['inode'] = os.stat(path).st_ino
+        return snapshot
+    finally:
+        for leftover in (raw_path, gz_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+# Every table the app uses. Each statement is IF NOT EXISTS, so this is run against
+# the live database when each pool starts up. The commute_logs view and the version
+# trigger come separately (create_logs_view), as they're generated from the routes'
+# checkpoints and the rule for which event counts.
+#
+# Everything is keyed by user first, then date, so one user's history is a range of
+# each index however many users and years there are.
+SCHEMA = f"""
+-- Routes are the checkpoints of a commute in the order they're passed, as JSON
+-- {{"out": [...], "return": [...]}}. Each user follows one route.
+CREATE TABLE IF NOT EXISTS routes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    journeys TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    route_id INTEGER NOT NULL REFERENCES routes (id)
+);
+
+-- Append-only log of checkpoint times. Nothing is ever updated or deleted: a second
+-- tap, or a correction, is just another row, and the commute_logs view works out
+-- which one counts. The index covers everything the view reads, so looking up a
+-- day (or a range of days) never touches the table itself. user_id defaults to the
+-- original user, which is what it was given when the column was added.
+CREATE TABLE IF NOT EXISTS commute_events (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER_ID},
+    date TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    source TEXT NOT NULL,
+    logged_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_commute_events_user_date ON commute_events (user_id, date, activity, source, ts);
+
+CREATE TRIGGER IF NOT EXISTS commute_events_no_update BEFORE UPDATE ON commute_events
+BEGIN
+    SELECT RAISE(ABORT, 'commute_events is append-only');
+END;
+
+CREATE TRIGGER IF NOT EXISTS commute_events_no_delete BEFORE DELETE ON commute_events
+BEGIN
+    SELECT RAISE(ABORT, 'commute_events is append-only');
+END;
+
+-- One row per tap submitted through /log_activity/batch, so a batch that is
+-- retried after a dropped connection is only applied once
+CREATE TABLE IF NOT EXISTS commute_log_events (
+    event_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER_ID},
+    date TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    logged_time TEXT NOT NULL,
+    status TEXT NOT NULL,
+    received_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+) WITHOUT ROWID;
+
+-- Row versions for incremental sync (/api/logs?since_version=N). Every event that
+-- changes what commute_logs shows for a user's day stamps it with the next version
+-- number, shared by all users (see the commute_events_version trigger, which is
+-- created along with the view). Days from before this table existed have no entry
+-- and count as version 0, and so do events copied over by migrate_wide_table, as
+-- those days' values haven't changed.
+CREATE TABLE IF NOT EXISTS commute_log_versions (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (user_id, date)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_commute_log_versions_user_version ON commute_log_versions (user_id, version);
+CREATE INDEX IF NOT EXISTS idx_commute_log_versions_version ON commute_log_versions (version);
+
+-- Segment durations (see commute_segments.py), rewritten for a day whenever one of
+-- its checkpoints is written, so analytics don't have to parse the text columns.
+-- straight_home is per day and filters the straight_home_only segments.
+CREATE TABLE IF NOT EXISTS commute_segments (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    duration_seconds INTEGER NOT NULL,
+    straight_home INTEGER NOT NULL,
+    PRIMARY KEY (user_id, segment, date)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_commute_segments_user_date ON commute_segments (user_id, date);
+
+-- Duration of each leg between neighbouring checkpoints of a journey on the user's
+-- route, rewritten for a day along with its segments. A leg is named after the
+-- checkpoint it starts from.
+CREATE TABLE IF NOT EXISTS commute_legs (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    leg TEXT NOT NULL,
+    start_seconds INTEGER NOT NULL,
+    duration_seconds INTEGER NOT NULL,
+    PRIMARY KEY (user_id, date, leg)
+) WITHOUT ROWID;
+
+-- Histogram of leg durations, to the minute, by weekday (0 = Sunday, as strftime's
+-- %w) and the hour the leg started, for /api/eta. The triggers keep it in step with
+-- commute_legs one row at a time, so it's never recomputed from the whole history.
+CREATE TABLE IF NOT EXISTS commute_leg_stats (
+    user_id INTEGER NOT NULL,
+    leg TEXT NOT NULL,
+    weekday INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    minutes INTEGER NOT NULL,
+    days INTEGER NOT NULL,
+    PRIMARY KEY (user_id, leg, weekday, hour, minutes)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS commute_legs_stats_insert AFTER INSERT ON commute_legs
+BEGIN
+    INSERT INTO commute_leg_stats (user_id, leg, weekday, hour, minutes, days)
+    VALUES (NEW.user_id, NEW.leg, CAST(strftime('%w', NEW.date) AS INTEGER), NEW.start_seconds / 3600,
+            NEW.duration_seconds / 60, 1)
+    ON CONFLICT(user_id, leg, weekday, hour, minutes) DO UPDATE SET days = days + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS commute_legs_stats_delete AFTER DELETE ON commute_legs
+BEGIN
+    UPDATE commute_leg_stats SET days = days - 1
+    WHERE user_id = OLD.user_id AND leg = OLD.leg AND weekday = CAST(strftime('%w', OLD.date) AS INTEGER)
+      AND hour = OLD.start_seconds / 3600 AND minutes = OLD.duration_seconds / 60;
+    DELETE FROM commute_leg_stats
+    WHERE user_id = OLD.user_id AND leg = OLD.leg AND weekday = CAST(strftime('%w', OLD.date) AS INTEGER)
+      AND hour = OLD.start_seconds / 3600 AND minutes = OLD.duration_seconds / 60 AND days <= 0;
+END;
+
+-- The original commuter and route, who everything from before there were users belongs to
+INSERT OR IGNORE INTO routes (id, name, journeys) VALUES ({DEFAULT_ROUTE_ID}, 'reading_scale_space', '{json.dumps(JOURNEYS)}');
+INSERT OR IGNORE INTO users (id, name, route_id) VALUES ({DEFAULT_USER_ID}, 'default', {DEFAULT_ROUTE_ID});
+"""
+
+
+# One row per user and day with a column per checkpoint, the shape commute_logs had
+# before it became a view. For each checkpoint the first button tap counts, unless
+# there's an external time or a correction, in which case the latest of those counts
+# instead. Migrated values are treated like taps, and always come first.
+#
+# That's done with a single GROUP BY user_id, date, so a WHERE on those is pushed
+# down into a search of the covering index (a window function or nested GROUP BY would make
+# SQLite scan every event). Each event gets a sort key of a class letter plus a
+# 15-digit number, 'b' + id for overriding sources, 'a' + (big - id) for taps, with
+# the time appended. The max() of that per checkpoint is the event that counts, and
+# the time is what's left after the 16-character key.
+_overriding = ', '.join(f"'{source}'" for source in OVERRIDING_SOURCES)
+_pick_key = (f"CASE WHEN source IN ({_overriding}) THEN 'b' || printf('%015d', id) "
+             f"ELSE 'a' || printf('%015d', 999999999999999 - id) END || ts")
+
+
+def commute_logs_view(columns):
+    """SQL for the commute_logs view with a column for each of these checkpoints"""
+    # Names are checked against CHECKPOINT_NAME, so they never contain a quote
+    checkpoint_columns = ',\n'.join(
+        f"    substr(max(CASE WHEN activity = '{col}' THEN {_pick_key} END), 17) AS \"{col}\"" for col in columns)
+    return f"""CREATE VIEW commute_logs AS
+SELECT
+    user_id,
+    date,
+{checkpoint_columns}
+FROM commute_events
+GROUP BY user_id, date"""
+
+
+# Bumps the day's version when an event changes the checkpoint's value in the view,
+# i.e. the value picked with the new event differs from the one picked without it. A
+# second tap, or Strava posting the same time again, leaves the version alone, so
+# synced copies don't fetch a day that hasn't changed. (An upsert rather than INSERT
+# OR REPLACE, as an OR REPLACE can be overridden by the conflict policy of the
+# statement that fired the trigger.)
+_picked = ('(SELECT substr(max({key}), 17) FROM commute_events '
+           'WHERE user_id = NEW.user_id AND date = NEW.date AND activity = NEW.activity{other})')
+VERSION_TRIGGER = f"""CREATE TRIGGER commute_events_version AFTER INSERT ON commute_events
+WHEN NEW.source <> 'migration'
+    AND {_picked.format(key=_pick_key, other='')} IS NOT {_picked.format(key=_pick_key, other=' AND id <> NEW.id')}
+BEGIN
+    INSERT INTO commute_log_versions (user_id, date, version)
+    VALUES (NEW.user_id, NEW.date, (SELECT coalesce(max(version), 0) + 1 FROM commute_log_versions))
+    ON CONFLICT(user_id, date) DO UPDATE SET version = excluded.version;
+END"""
+
+
+def view_columns(conn):
+    """The original checkpoints in table order, then any others the routes use"""
+    columns = list(time_columns)
+    for route in conn.execute('SELECT id, name, journeys FROM routes ORDER BY id').fetchall():
+        # Compiling checks the names, as they go into the view's SQL
+        for checkpoint in compile_route(*route).checkpoints:
+            if checkpoint not in columns:
+                columns.append(checkpoint)
+    return columns
+
+
+def create_logs_view(conn):
+    """(Re)create the commute_logs view if it's missing or the routes' checkpoints have changed
+
+    The version trigger picks events the same way as the view, so it's (re)created
+    here too. The check, the DROP and the CREATE happen in one BEGIN IMMEDIATE, so two
+    processes starting together can't both recreate them, and nobody ever sees them
+    missing. If the caller already has a transaction open, this is part of it and
+    the caller commits.
+    """
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute("SELECT type, sql FROM sqlite_master WHERE name = 'commute_logs'").fetchone()
+        if row is not None and row[0] == 'table':
+            raise sqlite3.OperationalError('commute_logs is still a table; run migrate_wide_table first')
+        view = commute_logs_view(view_columns(conn))
+        if row is None or row[1] != view:
+            conn.execute('DROP VIEW IF EXISTS commute_logs')
+            conn.execute(view)
+        trigger = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'commute_events_version'").fetchone()
+        if trigger is None or trigger[0] != VERSION_TRIGGER:
+            conn.execute('DROP TRIGGER IF EXISTS commute_events_version')
+            conn.execute(VERSION_TRIGGER)
+        if own_transaction:
+            conn.commit()
+    except Exception:
+        if own_transaction:
+            conn.rollback()
+        raise
+
+
+def _columns(conn, table):
+    return {info[1] for info in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def migrate_single_user(conn):
+    """Give a database from before there were users a user_id everywhere, all for the original user
+
+    commute_events and commute_log_events get the column (defaulting to user 1),
+    commute_log_versions is rebuilt with it in its key, and the view and the
+    tables derived from the events are dropped, to be recreated by SCHEMA and
+    refilled by backfill_segments. Each table is checked on its own, as a database
+    from before commute_events has the other two but not it. One transaction; does
+    nothing for a new or already migrated database. Run before SCHEMA. Returns
+    whether it did anything.
+    """
+    try:
+        # Checked inside the transaction, so another process can't migrate in between
+        conn.execute('BEGIN IMMEDIATE')
+        events, log_events, versions = (_columns(conn, table) for table in
+                                        ('commute_events', 'commute_log_events', 'commute_log_versions'))
+        if not any(columns and 'user_id' not in columns for columns in (events, log_events, versions)):
+            conn.rollback()
+            return False
+
+        if events and 'user_id' not in events:
+            conn.execute('DROP VIEW IF EXISTS commute_logs')
+            conn.execute('DROP TRIGGER IF EXISTS commute_events_version')
+            conn.execute(f'ALTER TABLE commute_events ADD COLUMN user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER_ID}')
+            conn.execute('DROP INDEX IF EXISTS idx_commute_events_date')
+        if log_events and 'user_id' not in log_events:
+            conn.execute(f'ALTER TABLE commute_log_events ADD COLUMN user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER_ID}')
+
+        if versions and 'user_id' not in versions:
+            # The wide table's version triggers upsert on date alone, so they can't
+            # outlive the old key. migrate_wide_table would drop them next anyway.
+            conn.execute('DROP TRIGGER IF EXISTS commute_logs_version_insert')
+            conn.execute('DROP TRIGGER IF EXISTS commute_logs_version_update')
+            # The same table as in SCHEMA, keeping every day's version so synced copies carry on
+            conn.execute('CREATE TABLE commute_log_versions_users (user_id INTEGER NOT NULL, date TEXT NOT NULL, '
+                         'version INTEGER NOT NULL, PRIMARY KEY (user_id, date)) WITHOUT ROWID')
+            conn.execute(f'INSERT INTO commute_log_versions_users SELECT {DEFAULT_USER_ID}, date, version '
+                         f'FROM commute_log_versions')
+            conn.execute('DROP TABLE commute_log_versions')
+            conn.execute('ALTER TABLE commute_log_versions_users RENAME TO commute_log_versions')
+
+        for table in ('commute_segments', 'commute_legs', 'commute_leg_stats'):
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
+
+
+def migrate_wide_table(conn):
+    """Turn a commute_logs table (one column per checkpoint) into commute_events rows
+
+    Every filled-in checkpoint becomes one event with source 'migration'. The old
+    table is kept as commute_logs_wide, so nothing is lost, and its triggers are
+    dropped. It all happens in one transaction, and does nothing if commute_logs
+    isn't a table (i.e. a new database, or one that's already been migrated).
+    Returns the number of events written. Needs SCHEMA to have been run first.
+    """
+    migrated = 0
+    try:
+        # Checked inside the transaction, so another process can't migrate in between
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'commute_logs'").fetchone()
+        if row is None or row[0] != 'table':
+            conn.rollback()
+            return 0
+
+        columns = {info[1] for info in conn.execute('PRAGMA table_info(commute_logs)')}
+        for col in time_columns:
+            if col in columns:
+                migrated += conn.execute(
+                    f"INSERT INTO commute_events (date, activity, ts, source) "
+                    f"SELECT date, '{col}', {col}, 'migration' FROM commute_logs "
+                    f"WHERE {col} IS NOT NULL AND {col} <> '' ORDER BY date"
+                ).rowcount
+        conn.execute('DROP TRIGGER IF EXISTS commute_logs_version_insert')
+        conn.execute('DROP TRIGGER IF EXISTS commute_logs_version_update')
+        conn.execute('ALTER TABLE commute_logs RENAME TO commute_logs_wide')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return migrated
+
+
+def create_schema(path):
+    """Create the tables and commute_logs view in a database file if they don't exist"""
+    conn = sqlite3.connect(path)
+    try:
+        migrate_single_user(conn)
+        conn.executescript(SCHEMA)
+        migrate_wide_table(conn)
+        create_logs_view(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,97 @@
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Logging for the Flask app. Request threads only put records on a queue; one
+# background thread writes them out, so a slow SD card never holds up a request.
+#
+# COMMUTETRACKR_ENV picks a profile, and COMMUTETRACKR_LOG_LEVEL overrides its level:
+#   production   ERROR and up, to the rotating log file and stderr (Apache's error.log)
+#   development  DEBUG and up, to the log file and stderr
+#   benchmark    ERROR and up, to the log file only, so timings aren't cluttered
+LOG_PROFILES = {
+    'production': {'level': 'ERROR', 'console': True},
+    'development': {'level': 'DEBUG', 'console': True},
+    'benchmark': {'level': 'ERROR', 'console': False},
+}
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_MAX_BYTES = 1024 * 1024     # rotate at 1 MB...
+LOG_BACKUPS = 3                 # ...keeping this many old files
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler that leaves flushing to the listener
+
+    A plain FileHandler flushes after every record. Here the listener calls
+    flush_batch() once it has emptied the queue, so a burst of records goes to
+    the card in one write.
+    """
+
+    _size = None
+
+    def flush(self):
+        pass
+
+    def shouldRollover(self, record):
+        # RotatingFileHandler seeks to the end of the file before every record to find
+        # its size, and seeking flushes the buffer. Instead the size is read once when
+        # the file is first opened, and each record adds its length (in characters,
+        # as RotatingFileHandler counts it).
+        if self.stream is None:
+            self.stream = self._open()
+        if self._size is None:
+            self._size = self.stream.tell()
+        length = len(f'{self.format(record)}{self.terminator}')
+        rollover = self.maxBytes > 0 and self._size + length >= self.maxBytes
+        # After a rollover this record starts the new file
+        self._size = (0 if rollover else self._size) + length
+        return rollover
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchingQueueListener(QueueListener):
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                getattr(handler, 'flush_batch', handler.flush)()
+
+
+_listener = None
+
+
+def configure_logging(log_path, env=None):
+    """Send every log record through a queue to handlers run on a background thread
+
+    Safe to call more than once; only the first call does anything. Returns the listener.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    env = env or os.environ.get('COMMUTETRACKR_ENV', 'production')
+    profile = LOG_PROFILES.get(env, LOG_PROFILES['production'])
+    level = os.environ.get('COMMUTETRACKR_LOG_LEVEL', profile['level']).upper()
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [BatchedRotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True)]
+    if profile['console']:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers[:] = [QueueHandler(log_queue)]
+
+    _listener = BatchingQueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(_listener.stop)
+    return _listener
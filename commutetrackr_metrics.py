@@ -0,0 +1,161 @@
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from commutetrackr_cache import cache_stats
+
+# Metrics for /metrics, in the Prometheus text format. They live in this process's
+# memory, which is all of them as mod_wsgi runs the app as one process (threads=5),
+# and start again from zero when Apache reloads.
+
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_label_text(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=REQUEST_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values = {}   # label values -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip((*self.buckets, '+Inf'), counts):
+                    cumulative += count
+                    labels = _label_text((*self.labels, 'le'), (*label_values, bound))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _label_text(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+request_duration = Histogram('commutetrackr_request_duration_seconds',
+                             'Time to handle a request, by endpoint', ('endpoint', 'method'))
+requests_total = Counter('commutetrackr_requests_total',
+                         'Responses sent, by endpoint and status code', ('endpoint', 'method', 'status'))
+sql_duration = Histogram('commutetrackr_sql_duration_seconds',
+                         'Time spent executing SQLite statements (COMMIT included), by kind of statement',
+                         ('statement',), SQL_BUCKETS)
+sql_errors = Counter('commutetrackr_sql_errors_total', 'SQLite statements that raised an error', ('statement',))
+
+METRICS = [request_duration, requests_total, sql_duration, sql_errors]
+
+
+def render_metrics():
+    """Everything, plus the record caches' hit counts, as Prometheus text"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    stats = cache_stats()
+    for kind, index in (('hits', 1), ('misses', 2)):
+        name = f'commutetrackr_cache_{kind}_total'
+        lines.append(f'# HELP {name} Record cache lookups that were {kind}, by cache')
+        lines.append(f'# TYPE {name} counter')
+        for stat in stats:
+            lines.append(f'{name}{_label_text(("cache",), (stat[0],))} {stat[index]}')
+    return '\n'.join(lines) + '\n'
+
+
+# SQL time and statement count for the request being handled on this thread,
+# for the slow-request log
+_request_sql = threading.local()
+
+
+def start_request_sql():
+    _request_sql.seconds = 0.0
+    _request_sql.statements = 0
+
+
+def request_sql():
+    """(statements, seconds) spent in SQLite by this thread since start_request_sql()"""
+    return getattr(_request_sql, 'statements', 0), getattr(_request_sql, 'seconds', 0.0)
+
+
+@lru_cache(maxsize=256)
+def statement_kind(sql):
+    """Low-cardinality label for a statement: its first keyword, plus the name for a PRAGMA"""
+    words = sql.split(None, 2)
+    if not words:
+        return 'EMPTY'
+    kind = words[0].upper()
+    if kind == 'PRAGMA' and len(words) > 1:
+        return f"PRAGMA {words[1].split('(')[0].split('=')[0].lower()}"
+    return kind
+
+
+def _observe_sql(kind, elapsed):
+    sql_duration.observe((kind,), elapsed)
+    if hasattr(_request_sql, 'seconds'):
+        _request_sql.seconds += elapsed
+        _request_sql.statements += 1
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that times every execute and commit into sql_duration
+
+    Only the execute itself is timed, not fetching the rows afterwards, which is
+    where the time goes for the small statements here anyway. COMMIT and
+    PRAGMA wal_checkpoint are where the SD card gets written to.
+    """
+
+    def _timed(self, kind, run, *args):
+        start = time.perf_counter()
+        try:
+            return run(*args)
+        except sqlite3.Error:
+            sql_errors.inc((kind,))
+            raise
+        finally:
+            _observe_sql(kind, time.perf_counter() - start)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(statement_kind(sql), super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._timed(statement_kind(sql), super().executemany, sql, parameters)
+
+    def executescript(self, script):
+        return self._timed('SCRIPT', super().executescript, script)
+
+    def commit(self):
+        return self._timed('COMMIT', super().commit)
@@ -0,0 +1,68 @@
+#! python3
+# One-off migration of commute_logs from one column per checkpoint to commute_events:
+#   python commutetrackr_migrate.py /home/pi/ftp/files/commutetrackr.db
+# The app does the same on startup, but running this first (with Apache stopped)
+# takes a backup and checks that every day reads back the same through the new view.
+
+import argparse
+import sqlite3
+import sys
+from commute_segments import time_columns
+from commutetrackr_db import SCHEMA, create_logs_view, migrate_single_user, migrate_wide_table
+from commutetrackr_queries import DEFAULT_USER_ID, backfill_segments
+
+
+def compare_days(conn):
+    """Days whose checkpoints differ between the old table and the commute_logs view"""
+    columns = ', '.join(time_columns)
+    old = {row[0]: row[1:] for row in conn.execute(f'SELECT date, {columns} FROM commute_logs_wide')}
+    new = {row[0]: row[1:] for row in conn.execute(f'SELECT date, {columns} FROM commute_logs WHERE user_id = ?',
+                                                   (DEFAULT_USER_ID,))}
+    blank = (None,) * len(time_columns)
+
+    differences = []
+    for day in sorted(old.keys() | new.keys()):
+        # Empty strings were never real times, and all-blank days aren't kept
+        before = tuple(value or None for value in old.get(day, blank))
+        if before != new.get(day, blank):
+            differences.append(day)
+    return differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move commute_logs into the append-only commute_events table')
+    parser.add_argument('database', help='path to commutetrackr.db')
+    parser.add_argument('--backup', help='where to copy the database first (default: <database>.pre-events)')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    try:
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'commute_logs'").fetchone()
+        if row is None or row[0] != 'table':
+            print('Nothing to do: commute_logs is not a table (already migrated, or a new database).')
+            return 0
+
+        backup = args.backup or f'{args.database}.pre-events'
+        conn.execute('VACUUM INTO ?', (backup,))
+        print(f'Backed up to {backup}')
+
+        migrate_single_user(conn)
+        conn.executescript(SCHEMA)
+        migrated = migrate_wide_table(conn)
+        create_logs_view(conn)
+        backfill_segments(conn)
+        print(f'Copied {migrated} checkpoint times into commute_events; the old table is now commute_logs_wide.')
+
+        differences = compare_days(conn)
+        if differences:
+            print(f'{len(differences)} days read back differently, e.g. {", ".join(differences[:5])}')
+            print(f'Restore from {backup} before starting the app.')
+            return 1
+        print('Every day reads back the same through the commute_logs view.')
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,417 @@
+import json
+import re
+from collections import namedtuple
+from functools import lru_cache
+from commute_segments import JOURNEYS, SEGMENTS, day_legs, day_segments, time_to_seconds
+
+# Checkpoints logged by the buttons on the web page
+BUTTON_ACTIVITIES = frozenset([
+    'boarded_train_out', 'alighted_train_out', 'boarded_tube_out',
+    'alighted_tube_out', 'arrived_at_scale_space', 'left_scale_space',
+    'boarded_tube_return', 'alighted_tube_return', 'boarded_train_return',
+    'alighted_train_return'
+])
+
+# Checkpoints posted by strava_commute_inserter.py
+EXTERNAL_ACTIVITIES = frozenset(['left_home', 'arrived_at_station', 'left_station', 'arrived_at_home'])
+
+# Where a commute_events row came from. For taps (and migrated values) the first
+# one counts; these sources are deliberate changes, so the latest of them wins.
+OVERRIDING_SOURCES = ('external', 'correction')
+
+# Everything logged before there were users belongs to user 1, on route 1 (JOURNEYS)
+DEFAULT_USER_ID = 1
+DEFAULT_ROUTE_ID = 1
+
+# Checkpoint names become columns of the commute_logs view, and column names can't
+# be bound as SQL parameters, so a route's checkpoints must look like this. They're
+# quoted in the view, so SQL keywords (order, from...) are fine, but the view's own
+# columns aren't.
+CHECKPOINT_NAME = re.compile(r'[a-z][a-z0-9_]{0,62}')
+RESERVED_COLUMNS = frozenset(['user_id', 'date'])
+
+# A route's ordered checkpoints, as {'out': [...], 'return': [...]}, with the
+# whitelists worked out from them: every checkpoint, and the ones that are buttons
+# (everything except the checkpoints Strava posts)
+Route = namedtuple('Route', ['id', 'name', 'journeys', 'checkpoints', 'activities', 'buttons'])
+User = namedtuple('User', ['id', 'name', 'route'])
+
+
+@lru_cache(maxsize=64)
+def compile_route(route_id, name, journeys_json):
+    """Parse and check a row of routes, once per process for each version of the row"""
+    journeys = json.loads(journeys_json)
+    if not isinstance(journeys, dict) or set(journeys) != set(JOURNEYS):
+        raise ValueError(f'Route {name} must have exactly these journeys: {", ".join(JOURNEYS)}')
+    checkpoints = tuple(checkpoint for journey in JOURNEYS for checkpoint in journeys[journey])
+    invalid = [checkpoint for checkpoint in checkpoints
+               if not isinstance(checkpoint, str) or not CHECKPOINT_NAME.fullmatch(checkpoint)
+               or checkpoint in RESERVED_COLUMNS]
+    if invalid or len(set(checkpoints)) != len(checkpoints):
+        raise ValueError(f'Route {name} has invalid or repeated checkpoints: {invalid or list(checkpoints)}')
+    activities = frozenset(checkpoints)
+    return Route(route_id, name, journeys, checkpoints, activities, activities - EXTERNAL_ACTIVITIES)
+
+
+USERS_SQL = '''
+SELECT u.id, u.name, r.id, r.name, r.journeys
+FROM users u JOIN routes r ON r.id = u.route_id
+'''
+
+
+def load_users(conn):
+    """Every user and their compiled route, as {name: User}"""
+    return {name: User(user_id, name, compile_route(route_id, route_name, journeys))
+            for user_id, name, route_id, route_name, journeys in conn.execute(USERS_SQL)}
+
+
+def get_user(conn, user_id=DEFAULT_USER_ID):
+    """One user and their compiled route, by id"""
+    row = conn.execute(USERS_SQL + 'WHERE u.id = ?', (user_id,)).fetchone()
+    if row is None:
+        raise ValueError(f'No user with id {user_id}')
+    return User(row[0], row[1], compile_route(*row[2:]))
+
+
+SELECT_DAY_SQL = 'SELECT * FROM commute_logs WHERE user_id = ? AND date = ?'
+INSERT_CHECKPOINT_SQL = 'INSERT INTO commute_events (user_id, date, activity, ts, source) VALUES (?, ?, ?, ?, ?)'
+
+
+def check_activities(values, route):
+    """Refuse checkpoint names that aren't on the route"""
+    unknown = set(values) - route.activities
+    if unknown:
+        raise ValueError(f'Unknown activities for route {route.name}: {sorted(unknown)}')
+
+
+def get_record(conn, day, user_id=DEFAULT_USER_ID):
+    """A user's commute_logs row for a day, all blanks if nothing has been logged yet"""
+    cursor = conn.execute(SELECT_DAY_SQL, (user_id, day))
+    record = cursor.fetchone()
+    if record is None:
+        # The same columns as a real row, whichever routes there are
+        return {**dict.fromkeys(column[0] for column in cursor.description), 'user_id': user_id, 'date': day}
+    return dict(record)
+
+
+def log_checkpoints(conn, day, values, source='button', user=None):
+    """Append checkpoint times for a user's day to commute_events.
+
+    Every time is kept, but whether it counts depends on the source (see
+    OVERRIDING_SOURCES): a tap on a checkpoint that's already been tapped is
+    recorded without changing the row. Returns the day's row afterwards and the
+    set of activities whose new time is now the one that counts. (Comparing the
+    row with values can't tell, as a second tap in the same second has the same
+    time.) The segments are only rewritten if the row changed. user defaults to
+    the original user. Caller commits.
+    """
+    user = user or get_user(conn)
+    check_activities(values, user.route)
+    before = get_record(conn, day, user.id)
+    conn.executemany(INSERT_CHECKPOINT_SQL, [(user.id, day, activity, ts, source) for activity, ts in values.items()])
+    record = get_record(conn, day, user.id)
+    if record != before:
+        refresh_segments(conn, record, user.route)
+    # The newest event always wins for these, and a tap only wins if it's the first
+    counted = {activity for activity in values if source in OVERRIDING_SOURCES or before[activity] is None}
+    return record, counted
+
+
+def log_many_days(conn, days, source='external', user=None):
+    """Append checkpoint times for many days with one executemany, e.g. a Strava backfill.
+
+    days maps each date to {activity: time}. Every day's segments are refreshed
+    afterwards. Returns the number of times logged. Caller commits, so the whole
+    lot goes in as one transaction.
+    """
+    user = user or get_user(conn)
+    for values in days.values():
+        check_activities(values, user.route)
+    rows = [(user.id, day, activity, ts, source) for day, values in days.items() for activity, ts in values.items()]
+    conn.executemany(INSERT_CHECKPOINT_SQL, rows)
+    for day in days:
+        refresh_segments(conn, get_record(conn, day, user.id), user.route)
+    return len(rows)
+
+
+DELETE_SEGMENTS_SQL = 'DELETE FROM commute_segments WHERE user_id = ? AND date = ?'
+INSERT_SEGMENT_SQL = ('INSERT INTO commute_segments '
+                      '(user_id, date, segment, activity, direction, duration_seconds, straight_home) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)')
+DELETE_LEGS_SQL = 'DELETE FROM commute_legs WHERE user_id = ? AND date = ?'
+INSERT_LEG_SQL = 'INSERT INTO commute_legs (user_id, date, leg, start_seconds, duration_seconds) VALUES (?, ?, ?, ?, ?)'
+
+
+def refresh_segments(conn, record, route):
+    """Rewrite a day's rows in commute_segments and commute_legs from its commute_logs row. Caller commits.
+
+    Segments are the SEGMENTS of the original route, so other routes only get the
+    ones whose checkpoints they share. Legs follow the record's own route. The
+    triggers on commute_legs take the old legs out of commute_leg_stats and put the
+    new ones in, so the ETA stats only change by this day.
+    """
+    key = (record['user_id'], record['date'])
+    straight_home, durations = day_segments(record)
+    conn.execute(DELETE_SEGMENTS_SQL, key)
+    conn.executemany(INSERT_SEGMENT_SQL, [(*key, *duration, straight_home) for duration in durations])
+    conn.execute(DELETE_LEGS_SQL, key)
+    conn.executemany(INSERT_LEG_SQL, [(*key, *leg) for leg in day_legs(record, route.journeys)])
+
+
+def backfill_segments(conn):
+    """Fill commute_segments and commute_legs from history when they've just been added to an existing database"""
+    # commute_legs is the newer of the two, so a database with only segments gets both
+    # redone. Checked inside the transaction, so two processes can't both do it.
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if conn.execute('SELECT 1 FROM commute_legs LIMIT 1').fetchone() is not None:
+            conn.rollback()
+            return
+        routes = {user.id: user.route for user in load_users(conn).values()}
+        # Column names from the cursor, so this works whatever the row_factory
+        cursor = conn.execute('SELECT * FROM commute_logs')
+        names = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            record = dict(zip(names, row))
+            if record['user_id'] in routes:
+                refresh_segments(conn, record, routes[record['user_id']])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+SELECT_EVENT_SQL = 'SELECT status, logged_time FROM commute_log_events WHERE event_id = ?'
+INSERT_EVENT_SQL = ('INSERT INTO commute_log_events (event_id, user_id, date, activity, logged_time, status) '
+                    'VALUES (?, ?, ?, ?, ?, ?)')
+
+
+def apply_events(conn, events, user=None):
+    """Apply queued button taps, each at most once however often it is resubmitted.
+
+    events are (event_id, day, activity, time) tuples that have already been
+    validated. Returns one (status, time) per event, where status is 'logged',
+    'already_logged' (an earlier tap on that checkpoint still counts, and its time
+    is returned) or, for an event_id seen before, the status it got the first time.
+    Caller commits.
+    """
+    user = user or get_user(conn)
+    results = []
+    for event_id, day, activity, logged_time in events:
+        previous = conn.execute(SELECT_EVENT_SQL, (event_id,)).fetchone()
+        if previous is not None:
+            results.append((previous[0], previous[1]))
+            continue
+
+        record, counted = log_checkpoints(conn, day, {activity: logged_time}, user=user)
+        status = 'logged' if activity in counted else 'already_logged'
+        logged_time = record[activity]
+
+        conn.execute(INSERT_EVENT_SQL, (event_id, user.id, day, activity, logged_time, status))
+        results.append((status, logged_time))
+    return results
+
+
+CURRENT_VERSION_SQL = 'SELECT coalesce(max(version), 0) FROM commute_log_versions'
+
+# Full download: every row, with rows older than the version table counting as 0
+ALL_RECORDS_SQL = '''
+SELECT l.*, coalesce(v.version, 0) AS row_version
+FROM commute_logs l LEFT JOIN commute_log_versions v ON v.user_id = l.user_id AND v.date = l.date
+WHERE l.user_id = ? AND l.date >= ?
+ORDER BY l.date
+'''
+
+# Delta: a range scan on the (user_id, version) index, so cost grows with changes, not
+# history. Ordering by date would make SQLite walk the user's whole (user_id, date)
+# primary key instead, so the days are sorted afterwards. Each changed day is then
+# looked up on its own, as that's an index search on the commute_logs view where a
+# join would make SQLite build the view for every day.
+CHANGED_DATES_SQL = '''
+SELECT date, version
+FROM commute_log_versions
+WHERE user_id = ? AND version > ? AND date >= ?
+ORDER BY version
+'''
+
+
+def get_changed_records(conn, since_version=0, since_date='', user_id=DEFAULT_USER_ID):
+    """A user's rows changed after a sync version and/or dated on or after a day, plus the current version
+
+    Versions are shared by every user, so they only ever go up.
+    """
+    # Read the version first: anything committed after it is sent again next time
+    current_version = conn.execute(CURRENT_VERSION_SQL).fetchone()[0]
+    if since_version <= 0:
+        return current_version, [dict(row) for row in conn.execute(ALL_RECORDS_SQL, (user_id, since_date))]
+
+    records = []
+    for day, version in conn.execute(CHANGED_DATES_SQL, (user_id, since_version, since_date)).fetchall():
+        row = conn.execute(SELECT_DAY_SQL, (user_id, day)).fetchone()
+        if row is not None:  # days that only ever had a blank row before commute_events
+            records.append({**dict(row), 'row_version': version})
+    records.sort(key=lambda record: record['date'])
+    return current_version, records
+
+
+# Days that weren't straight home only count for the segments that don't care
+_STRAIGHT_HOME_ONLY = ', '.join(f"'{segment[0]}'" for segment in SEGMENTS if segment[4])
+SUMMARY_FILTER = f'user_id = ? AND date >= ? AND (straight_home OR segment NOT IN ({_STRAIGHT_HOME_ONLY}))'
+
+SEGMENT_TOTALS_SQL = f'''
+SELECT segment, activity, direction, count(*) AS days,
+       sum(duration_seconds) AS total_seconds, avg(duration_seconds) AS mean_seconds
+FROM commute_segments
+WHERE {SUMMARY_FILTER}
+GROUP BY segment
+'''
+
+# Nearest-rank quantiles: the smallest duration at or above each fraction of the days
+WEEKDAY_STATS_SQL = f'''
+WITH ranked AS (
+    SELECT segment, CAST(strftime('%w', date) AS INTEGER) AS weekday, duration_seconds,
+           row_number() OVER (PARTITION BY segment, strftime('%w', date) ORDER BY duration_seconds) AS rank,
+           count(*) OVER (PARTITION BY segment, strftime('%w', date)) AS days
+    FROM commute_segments
+    WHERE {SUMMARY_FILTER}
+)
+SELECT segment, weekday, days, avg(duration_seconds) AS mean_seconds,
+       min(CASE WHEN rank >= 0.25 * days THEN duration_seconds END) AS p25_seconds,
+       min(CASE WHEN rank >= 0.5 * days THEN duration_seconds END) AS p50_seconds,
+       min(CASE WHEN rank >= 0.75 * days THEN duration_seconds END) AS p75_seconds,
+       min(CASE WHEN rank >= 0.9 * days THEN duration_seconds END) AS p90_seconds
+FROM ranked
+GROUP BY segment, weekday
+'''
+
+DOOR_TO_DOOR_SQL = f'''
+SELECT date, direction, duration_seconds
+FROM commute_segments
+WHERE segment IN ('door_to_door_out', 'door_to_door_return') AND {SUMMARY_FILTER}
+ORDER BY date
+'''
+
+WEEKDAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+
+def get_summary(conn, since_date='', user_id=DEFAULT_USER_ID):
+    """A user's aggregate stats from commute_segments, from since_date on, as a JSON-ready dict"""
+    params = (user_id, since_date)
+    segments = [dict(row) for row in conn.execute(SEGMENT_TOTALS_SQL, params)]
+    weekdays = [dict(row) for row in conn.execute(WEEKDAY_STATS_SQL, params)]
+    for row in weekdays:
+        row['weekday'] = WEEKDAY_NAMES[row['weekday']]
+
+    door_to_door = {'out': {}, 'return': {}}
+    for day, direction, seconds in conn.execute(DOOR_TO_DOOR_SQL, params):
+        door_to_door[direction][day] = seconds
+
+    return {
+        'since': since_date or None,
+        'total_commuting_seconds': sum(door_to_door['out'].values()) + sum(door_to_door['return'].values()),
+        'segments': segments,
+        'weekdays': weekdays,
+        'door_to_door': door_to_door,
+    }
+
+
+# Arrival predictions (/api/eta) use the leg stats for the same weekday and starting
+# hour when there are at least this many days of them, and otherwise fall back to
+# any weekday at that hour, that weekday at any hour, then every day there is
+ETA_MIN_DAYS = 3
+
+LEG_STATS_SQL = 'SELECT leg, weekday, hour, minutes, days FROM commute_leg_stats WHERE user_id = ?'
+
+
+def _duration_quantiles(histogram):
+    """Nearest-rank median and 90th percentile (in seconds, mid-minute) of a {minutes: days} histogram"""
+    days = sum(histogram.values())
+    quantiles = {'days': days}
+    for name, fraction in (('p50_seconds', 0.5), ('p90_seconds', 0.9)):
+        seen = 0
+        for minutes in sorted(histogram):
+            seen += histogram[minutes]
+            if seen >= fraction * days:
+                quantiles[name] = minutes * 60 + 30
+                break
+    return quantiles
+
+
+def load_leg_stats(conn, user_id=DEFAULT_USER_ID):
+    """Quantiles of how long each of a user's legs takes, keyed by (leg, weekday, hour), where None is any
+
+    Built from the commute_leg_stats histogram, which is small however long the
+    history, so this is cheap enough to redo after every write and cache in between.
+    """
+    histograms = {}
+    for leg, weekday, hour, minutes, days in conn.execute(LEG_STATS_SQL, (user_id,)):
+        for key in ((leg, weekday, hour), (leg, None, hour), (leg, weekday, None), (leg, None, None)):
+            histogram = histograms.setdefault(key, {})
+            histogram[minutes] = histogram.get(minutes, 0) + days
+    return {key: _duration_quantiles(histogram) for key, histogram in histograms.items()}
+
+
+def _leg_estimate(stats, leg, weekday, hour):
+    for key in ((leg, weekday, hour), (leg, None, hour), (leg, weekday, None)):
+        estimate = stats.get(key)
+        if estimate is not None and estimate['days'] >= ETA_MIN_DAYS:
+            return estimate
+    return stats.get((leg, None, None))
+
+
+def _clock(seconds):
+    seconds = int(seconds) % 86400
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def estimate_arrival(stats, record, weekday, now_seconds, journey=None, journeys=JOURNEYS):
+    """Likely arrival time for today's journey, adding up the usual time of each leg still to go
+
+    journey is 'out' or 'return', or None to pick the one in progress (or, if neither
+    has started, the next one, as if leaving now), on a route's journeys. Returns a JSON-ready dict with the
+    median arrival time and a later one that 90% of each leg finished within. If any
+    leg still to go has no history at all, both are None and those legs are listed
+    in missing, rather than giving a time that leaves them out.
+    """
+    if journey is None:
+        started = {name: any(record.get(checkpoint) for checkpoint in checkpoints)
+                   for name, checkpoints in journeys.items()}
+        # The way home once it's begun, once I've got to Scale Space, or in the
+        # afternoon if I never set off this morning
+        if started['return'] or record.get(journeys['out'][-1]) or (not started['out'] and now_seconds >= 12 * 3600):
+            journey = 'return'
+        else:
+            journey = 'out'
+    checkpoints = journeys[journey]
+    result = {'journey': journey, 'destination': checkpoints[-1]}
+
+    if record.get(checkpoints[-1]):
+        return {**result, 'arrived': True, 'eta': record[checkpoints[-1]]}
+
+    logged = [index for index, checkpoint in enumerate(checkpoints) if time_to_seconds(record.get(checkpoint)) is not None]
+    if logged:
+        start = logged[-1]
+        median = latest = time_to_seconds(record[checkpoints[start]])
+    else:
+        start, median = 0, now_seconds
+        latest = median
+    result.update({'arrived': False, 'from': checkpoints[start], 'from_time': _clock(median),
+                   'starting_now': not logged})
+
+    legs = []
+    missing = []
+    for leg, end in zip(checkpoints[start:], checkpoints[start + 1:]):
+        estimate = _leg_estimate(stats, leg, weekday, median // 3600)
+        if estimate is None:
+            legs.append({'leg': leg, 'to': end, 'days': 0})
+            missing.append(leg)
+            continue
+        median += estimate['p50_seconds']
+        latest += estimate['p90_seconds']
+        legs.append({'leg': leg, 'to': end, **estimate})
+
+    if missing:
+        result.update({'eta': None, 'eta_p90': None, 'legs': legs, 'missing': missing})
+    else:
+        result.update({'eta': _clock(median), 'eta_p90': _clock(latest), 'legs': legs, 'missing': []})
+    return result
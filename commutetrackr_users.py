@@ -0,0 +1,79 @@
+#! python3
+# Users and their routes, for running one CommuteTrackr for several people:
+#   python commutetrackr_users.py /home/pi/ftp/files/commutetrackr.db list
+#   python commutetrackr_users.py commutetrackr.db add-route bracknell_waterloo \
+#       --out left_home,boarded_train_out,alighted_train_out,arrived_at_office \
+#       --return left_office,boarded_train_return,alighted_train_return,arrived_at_home
+#   python commutetrackr_users.py commutetrackr.db add-user sam --route bracknell_waterloo
+# Sam's page is then /commutetrackr/?user=sam, and the API takes ?user=sam too.
+# The app notices new users and routes without a restart.
+
+import argparse
+import json
+import sqlite3
+import sys
+from commutetrackr_db import create_logs_view, create_schema
+from commutetrackr_queries import compile_route, load_users
+
+
+def add_route(conn, name, out, back):
+    journeys = json.dumps({'out': out, 'return': back})
+    compile_route(None, name, journeys)  # raises if a checkpoint name won't do
+    # New checkpoints need columns in the commute_logs view. The route and the new
+    # view go in together, so if either fails the database is left as it was.
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('INSERT INTO routes (name, journeys) VALUES (?, ?)', (name, journeys))
+        create_logs_view(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def add_user(conn, name, route_name):
+    row = conn.execute('SELECT id FROM routes WHERE name = ?', (route_name,)).fetchone()
+    if row is None:
+        raise ValueError(f'No route called {route_name}')
+    conn.execute('INSERT INTO users (name, route_id) VALUES (?, ?)', (name, row[0]))
+    conn.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage CommuteTrackr users and routes')
+    parser.add_argument('database', help='path to commutetrackr.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='show every user and their route')
+    route = commands.add_parser('add-route', help='add a route, as its checkpoints in the order they are passed')
+    route.add_argument('name')
+    route.add_argument('--out', required=True, help='comma-separated checkpoints on the way to work')
+    route.add_argument('--return', dest='back', required=True, help='comma-separated checkpoints on the way home')
+    user = commands.add_parser('add-user', help='add a user following an existing route')
+    user.add_argument('name')
+    user.add_argument('--route', required=True)
+    args = parser.parse_args(argv)
+
+    create_schema(args.database)
+    conn = sqlite3.connect(args.database)
+    try:
+        if args.command == 'add-route':
+            add_route(conn, args.name, args.out.split(','), args.back.split(','))
+            print(f'Added route {args.name}')
+        elif args.command == 'add-user':
+            add_user(conn, args.name, args.route)
+            print(f'Added {args.name}; their page is /commutetrackr/?user={args.name}')
+        else:
+            for user in load_users(conn).values():
+                print(f'{user.name} (id {user.id}): {user.route.name}')
+                for journey, checkpoints in user.route.journeys.items():
+                    print(f'    {journey}: {" -> ".join(checkpoints)}')
+        return 0
+    except (ValueError, sqlite3.Error) as e:
+        print(f'Error: {e}')
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
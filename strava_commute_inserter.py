@@ -1,57 +1,248 @@
-#! python3
-
-import requests
-from datetime import datetime, date, timedelta
-from dateutil import parser as date_parser
-import urllib3
-urllib3.disable_warnings()
-
-payload = {
-'client_id': 'ID',
-'client_secret': 'SECRET',
-'refresh_token': 'TOKEN',
-'grant_type': "refresh_token",
-'f': 'json'
-}
-
-res = requests.post('https://www.strava.com/oauth/token', data=payload, verify=False)
-access_token = res.json()['access_token']
-headers = {'Authorization': f'Authorization: Bearer {access_token}'}
-activities = requests.get('https://www.strava.com/api/v3/athlete/activities?per_page=5', headers=headers, verify=False).json()
-
-list_of_times = []
-
-for activity in activities:
-    start_time = date_parser.parse(activity['start_date_local'])
-    activity_date = start_time.date()
-    
-    if (activity_date == date.today() and activity.get('type', '') == "Ride"):
-        duration_seconds = activity.get('elapsed_time', 0)
-        end_time = start_time + timedelta(seconds=duration_seconds)
-        
-        list_of_times.append(start_time)
-        list_of_times.append(end_time)
-        
-list_of_times.sort()
-
-if len(list_of_times) == 0:
-    print("⚠️ No rides found for today")
-    exit
-
-commute_data = {'left_home': list_of_times[0].strftime('%H:%M:%S'),
-                'arrived_at_station': list_of_times[1].strftime('%H:%M:%S'),
-                'left_station': list_of_times[2].strftime('%H:%M:%S'),
-                'arrived_at_home': list_of_times[3].strftime('%H:%M:%S')}
-
-print("\n🗺️  Mapped commute data:")
-for key, value in commute_data.items():
-    print(f"   {key}: {value}")
-
-response = requests.post("http://192.168.0.101:1010/commutetrackr/api/log_external",
-    json=commute_data,
-    headers={'Content-Type': 'application/json'})
-
-result = response.json()
-
-if result.get('success'):
-    print("\n✅ Successfully updated CommuteTrackr")
+#! python3
+# Posts today's cycle rides from Strava to CommuteTrackr:
+#   python strava_commute_inserter.py
+# or loads every day's rides in a date range, a chunk of days per request:
+#   python strava_commute_inserter.py --backfill 2025-01-01 [--until 2025-03-31]
+# STRAVA_URL and COMMUTETRACKR_URL can point it somewhere else, e.g. strava_stub.py, and
+# COMMUTETRACKR_USER logs the rides for someone other than the original user.
+
+import argparse
+import json
+import os
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from dateutil import parser as date_parser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import urllib3
+urllib3.disable_warnings()
+
+STRAVA_URL = os.environ.get('STRAVA_URL', 'https://www.strava.com')
+COMMUTETRACKR_URL = os.environ.get('COMMUTETRACKR_URL', "http://192.168.0.101:1010/commutetrackr")
+COMMUTETRACKR_USER = os.environ.get('COMMUTETRACKR_USER')
+USER_PARAMS = {'user': COMMUTETRACKR_USER} if COMMUTETRACKR_USER else {}
+
+payload = {
+'client_id': 'ID',
+'client_secret': 'SECRET',
+'refresh_token': 'TOKEN',
+'grant_type': "refresh_token",
+'f': 'json'
+}
+
+# Access tokens last six hours, so most runs can skip the OAuth round trip. Strava
+# may also hand out a new refresh token, which is kept here and used from then on.
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.commutetrackr', 'strava_token.json')
+TOKEN_EXPIRY_MARGIN = 300   # seconds; refresh a token this close to expiring
+
+# (connect, read) timeouts in seconds for every request, so a slow Strava or Pi
+# can't hang the run
+TIMEOUT = (5, 30)
+
+# GETs are retried with exponential backoff after connection errors, read timeouts
+# and 5xx responses. POSTs only after a connection error, when nothing was sent:
+# after a timeout or a 5xx the server may already have committed, and as
+# commute_events is append-only, sending them again would log every time twice.
+# (urllib3 only retries reads and statuses for the methods in its default
+# allowed_methods, which leave out POST.)
+RETRIES = Retry(total=4, backoff_factor=1, status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False, respect_retry_after_header=False)
+
+# Strava's rate limit (429) gets its own, capped, backoff (see strava_get), rather
+# than urllib3's, which would sleep for as long as any Retry-After says
+RATE_LIMIT_RETRIES = 3
+MAX_RATE_LIMIT_WAIT = 60    # seconds
+
+# Strava's maximum page size for listing activities
+PAGE_SIZE = 200
+
+# A backfill is split into windows of this many days, fetched side by side. At two
+# rides a day a window fits in one page.
+WINDOW_DAYS = 60
+FETCH_WORKERS = 4
+
+# Days per POST to /api/log_external/bulk (the server takes up to 366)
+BULK_CHUNK_DAYS = 100
+
+# Rides starting before this hour are the cycle to the station, later ones the cycle home
+MIDDAY = 12
+
+
+def make_session():
+    """One pooled session for the whole run, so Strava and the Pi each get one kept-alive connection"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=FETCH_WORKERS, max_retries=RETRIES)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.verify = False
+    return session
+
+
+def load_cached_token():
+    try:
+        with open(TOKEN_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cached_token(token):
+    # Write then rename, and only readable by me, as it holds the refresh token
+    os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+    tmp_path = f'{TOKEN_CACHE_PATH}.tmp'
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(token, f)
+    os.replace(tmp_path, TOKEN_CACHE_PATH)
+
+
+def authorise(session):
+    """Set the session's Authorization header, from the cached token if it's still valid"""
+    token = load_cached_token()
+    if token.get('expires_at', 0) - TOKEN_EXPIRY_MARGIN < time.time():
+        refresh_payload = dict(payload, refresh_token=token.get('refresh_token', payload['refresh_token']))
+        res = session.post(f'{STRAVA_URL}/oauth/token', data=refresh_payload, timeout=TIMEOUT)
+        res.raise_for_status()
+        token = {key: res.json()[key] for key in ('access_token', 'refresh_token', 'expires_at')}
+        save_cached_token(token)
+    session.headers['Authorization'] = f'Bearer {token["access_token"]}'
+
+
+def rate_limit_wait(response, attempt):
+    """Seconds to wait after a 429: Retry-After if given, otherwise doubling from 5s, never more than the cap"""
+    try:
+        wait = float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        wait = 5 * 2 ** attempt
+    return min(wait, MAX_RATE_LIMIT_WAIT)
+
+
+def strava_get(session, path, params):
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        response = session.get(f'{STRAVA_URL}/api/v3/{path}', params=params, timeout=TIMEOUT)
+        if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            response.raise_for_status()
+            return response.json()
+        print(f"⏳ Strava rate limit reached (usage {response.headers.get('X-RateLimit-Usage', '?')}), backing off")
+        time.sleep(rate_limit_wait(response, attempt))
+
+
+def fetch_window(session, after, before):
+    """Every activity that started between two datetimes, paging through Strava"""
+    activities = []
+    page = 1
+    while True:
+        batch = strava_get(session, 'athlete/activities',
+                           {'after': int(after.timestamp()), 'before': int(before.timestamp()),
+                            'page': page, 'per_page': PAGE_SIZE})
+        activities.extend(batch)
+        if len(batch) < PAGE_SIZE:
+            return activities
+        page += 1
+
+
+def fetch_rides(session, after, before):
+    """Every ride that started between two datetimes, as {date: [(start, end), ...]}
+
+    Long ranges are split into windows that are fetched concurrently.
+    """
+    windows = []
+    while after < before:
+        windows.append((after, min(after + timedelta(days=WINDOW_DAYS), before)))
+        after = windows[-1][1]
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        pages = list(pool.map(lambda window: fetch_window(session, *window), windows))
+
+    rides = {}
+    for activities in pages:
+        for activity in activities:
+            if activity.get('type', '') != "Ride":
+                continue
+            start_time = date_parser.parse(activity['start_date_local'])
+            end_time = start_time + timedelta(seconds=activity.get('elapsed_time', 0))
+            rides.setdefault(start_time.date(), []).append((start_time, end_time))
+    return rides
+
+
+def commute_checkpoints(day_rides):
+    """Map one day's rides onto the cycling checkpoints
+
+    The first ride of the morning is home to the station and the last ride after
+    midday is the station to home. Either can be missing, and anything in between
+    (e.g. a lunchtime ride) is ignored.
+    """
+    day_rides = sorted(day_rides)
+    commute_data = {}
+    if day_rides[0][0].hour < MIDDAY:
+        commute_data['left_home'] = day_rides[0][0].strftime('%H:%M:%S')
+        commute_data['arrived_at_station'] = day_rides[0][1].strftime('%H:%M:%S')
+    if day_rides[-1][0].hour >= MIDDAY:
+        commute_data['left_station'] = day_rides[-1][0].strftime('%H:%M:%S')
+        commute_data['arrived_at_home'] = day_rides[-1][1].strftime('%H:%M:%S')
+    return commute_data
+
+
+def log_today(session):
+    today = date.today()
+    rides = fetch_rides(session, datetime.combine(today, datetime.min.time()), datetime.now() + timedelta(hours=1))
+
+    if today not in rides:
+        print("⚠️ No rides found for today")
+        return
+
+    commute_data = commute_checkpoints(rides[today])
+
+    print("\n🗺️  Mapped commute data:")
+    for key, value in commute_data.items():
+        print(f"   {key}: {value}")
+
+    response = session.post(f"{COMMUTETRACKR_URL}/api/log_external", params=USER_PARAMS, json=commute_data,
+                            timeout=TIMEOUT)
+
+    result = response.json()
+
+    if result.get('success'):
+        print("\n✅ Successfully updated CommuteTrackr")
+
+
+def backfill(session, since, until):
+    """Load the rides for every day from since to until (inclusive), a chunk of days per request"""
+    rides = fetch_rides(session, datetime.combine(since, datetime.min.time()),
+                        datetime.combine(until + timedelta(days=1), datetime.min.time()))
+    days = [{'date': day.isoformat(), **commute_checkpoints(day_rides)} for day, day_rides in sorted(rides.items())]
+    print(f"🗺️  Found rides on {len(days)} days between {since} and {until}")
+
+    for start in range(0, len(days), BULK_CHUNK_DAYS):
+        chunk = days[start:start + BULK_CHUNK_DAYS]
+        response = session.post(f"{COMMUTETRACKR_URL}/api/log_external/bulk", params=USER_PARAMS,
+                                json={'days': chunk}, timeout=TIMEOUT)
+        result = response.json()
+
+        if not result.get('success'):
+            print(f"\n❌ Failed on the days from {chunk[0]['date']}: {result.get('error')}")
+            return
+        print(f"   {chunk[0]['date']} to {chunk[-1]['date']}: logged {result['logged']} times")
+
+    print("\n✅ Successfully backfilled CommuteTrackr")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Send cycle rides from Strava to CommuteTrackr')
+    parser.add_argument('--backfill', type=date.fromisoformat, metavar='YYYY-MM-DD',
+                        help='load every day from this date on, instead of just today')
+    parser.add_argument('--until', type=date.fromisoformat, default=date.today(), metavar='YYYY-MM-DD',
+                        help='last day to backfill (default: today)')
+    args = parser.parse_args(argv)
+
+    with make_session() as session:
+        authorise(session)
+        if args.backfill:
+            backfill(session, args.backfill, args.until)
+        else:
+            log_today(session)
+
+
+if __name__ == '__main__':
+    main()
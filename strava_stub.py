@@ -0,0 +1,103 @@
+#! python3
+# Stand-in for the bits of the Strava API the inserter uses, for trying it out without
+# touching the real account or its rate limit:
+#   python strava_stub.py --port 8089 --latency 0.2 --rate-limit-every 5
+#   STRAVA_URL=http://127.0.0.1:8089 python strava_commute_inserter.py --backfill 2025-01-01
+# Every weekday gets a ride at 07:01 and one at 18:03. Requests are counted and printed.
+
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN_LIFETIME = 6 * 3600   # seconds, as Strava's
+
+
+def weekday_rides(after, before):
+    """Synthetic commute rides between two epoch times, newest first like Strava"""
+    rides = []
+    day = datetime.fromtimestamp(after).replace(hour=0, minute=0, second=0)
+    while day.timestamp() < before:
+        if day.weekday() < 5:
+            for start, elapsed in ((timedelta(hours=7, minutes=1), 840), (timedelta(hours=18, minutes=3), 900)):
+                if after <= (day + start).timestamp() < before:
+                    rides.append({'type': 'Ride', 'elapsed_time': elapsed,
+                                  'start_date_local': (day + start).strftime('%Y-%m-%dT%H:%M:%SZ')})
+        day += timedelta(days=1)
+    return rides[::-1]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    counts = {}
+    lock = threading.Lock()
+    latency = 0
+    rate_limit_every = 0
+
+    def respond(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            total = sum(self.counts.values())
+        print(f'{name}: {self.counts[name]} (all requests: {total})')
+        return total
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlparse(self.path).path != '/oauth/token':
+            return self.respond(404, {'message': 'Not Found'})
+        self.count('token')
+        self.respond(200, {'access_token': 'stub-access', 'refresh_token': 'stub-refresh',
+                           'expires_at': int(time.time()) + TOKEN_LIFETIME})
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path != '/api/v3/athlete/activities':
+            return self.respond(404, {'message': 'Not Found'})
+        if self.headers.get('Authorization') != 'Bearer stub-access':
+            return self.respond(401, {'message': 'Authorization Error'})
+
+        total = self.count('activities')
+        if self.rate_limit_every and total % self.rate_limit_every == 0:
+            return self.respond(429, {'message': 'Rate Limit Exceeded'},
+                                {'Retry-After': '1', 'X-RateLimit-Usage': '100,1000'})
+
+        query = {key: int(values[0]) for key, values in parse_qs(url.query).items()}
+        rides = weekday_rides(query.get('after', 0), query.get('before', int(time.time())))
+        page, per_page = query.get('page', 1), query.get('per_page', 30)
+        self.respond(200, rides[(page - 1) * per_page:page * per_page])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stub of the Strava API for strava_commute_inserter.py')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before every response')
+    parser.add_argument('--rate-limit-every', type=int, default=0, metavar='N',
+                        help='answer every Nth activities request with a 429')
+    args = parser.parse_args(argv)
+
+    StubHandler.latency = args.latency
+    StubHandler.rate_limit_every = args.rate_limit_every
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StubHandler)
+    print(f'Stub Strava API on http://127.0.0.1:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
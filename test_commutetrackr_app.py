@@ -0,0 +1,118 @@
+# Tests for commutetrackr_app.py against a fresh database in a temporary directory:
+#   python -m pytest test_commutetrackr_app.py
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+import pytest
+
+# The app reads these when it's imported, so they're set first
+os.environ.setdefault('COMMUTETRACKR_LOG', os.path.join(tempfile.gettempdir(), 'commutetrackr_test.log'))
+os.environ.setdefault('COMMUTETRACKR_ENV', 'benchmark')
+
+import commutetrackr_app
+from commutetrackr_cache import get_record_cache
+from commutetrackr_db import create_schema, get_pool, write_snapshot
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    """A test client for the app, with a database (and snapshot) of its own"""
+    database = str(tmp_path / 'commutetrackr.db')
+    create_schema(database)
+    monkeypatch.setattr(commutetrackr_app, 'DATABASE_PATH', database)
+    monkeypatch.setattr(commutetrackr_app, 'SNAPSHOT_PATH', str(tmp_path / 'commutetrackr_snapshot.db.gz'))
+    return commutetrackr_app.app.test_client()
+
+
+def send_batch(client, *events):
+    response = client.post('/log_activity/batch', json={'events': list(events)})
+    assert response.status_code == 200
+    return response.get_json()['results']
+
+
+def tap(event_id, client_timestamp, activity='boarded_train_out'):
+    return {'event_id': event_id, 'activity': activity, 'client_timestamp': client_timestamp}
+
+
+def test_batch_logs_the_time_of_the_tap(client):
+    tapped_at = datetime.now().replace(microsecond=0) - timedelta(minutes=3)
+    [result] = send_batch(client, tap('a', tapped_at.isoformat()))
+    assert result == {'event_id': 'a', 'status': 'logged', 'timestamp': tapped_at.strftime('%H:%M:%S')}
+
+
+def test_batch_rejects_a_date_without_a_time(client):
+    today = datetime.now().date().isoformat()
+    [result] = send_batch(client, tap('a', today))
+    assert result['status'] == 'invalid'
+    assert 'client_timestamp' in result['error']
+
+
+def test_batch_rejects_taps_older_than_the_queue_window(client):
+    stale = datetime.now() - commutetrackr_app.MAX_QUEUED_AGE - timedelta(minutes=1)
+    recent = datetime.now() - commutetrackr_app.MAX_QUEUED_AGE + timedelta(minutes=1)
+    stale_result, recent_result = send_batch(client, tap('stale', stale.isoformat()),
+                                             tap('recent', recent.isoformat(), 'alighted_train_out'))
+    assert stale_result['status'] == 'invalid'
+    assert 'days old' in stale_result['error']
+    assert recent_result['status'] == 'logged'
+
+
+def test_snapshot_replaced_behind_the_cache_is_rebuilt(client):
+    # The pool's own schema check on startup costs one reload, so the third request is the first hit
+    for _ in range(3):
+        first = client.get('/api/snapshot')
+        assert first.status_code == 200
+        first.close()
+    assert get_record_cache(commutetrackr_app.DATABASE_PATH, 'snapshot').hits == 1
+
+    # Another process rebuilding the snapshot replaces the file this one has cached
+    path = commutetrackr_app.SNAPSHOT_PATH
+    inode = os.stat(path).st_ino
+    replaced = write_snapshot(get_pool(commutetrackr_app.DATABASE_PATH), path)
+    assert replaced['inode'] != inode
+
+    second = client.get('/api/snapshot')
+    assert second.status_code == 200
+    assert second.headers['X-Checksum-SHA256'] == replaced['sha256']
+    second.close()
+
+
+def current_version():
+    with get_pool(commutetrackr_app.DATABASE_PATH).connection() as conn:
+        return conn.execute('SELECT coalesce(max(version), 0) FROM commute_log_versions').fetchone()[0]
+
+
+def test_second_tap_in_the_same_second_does_not_count(client):
+    tapped_at = datetime.now().replace(microsecond=0).isoformat()
+    first, second = send_batch(client, tap('a', tapped_at), tap('b', tapped_at))
+    assert first['status'] == 'logged'
+    assert second['status'] == 'already_logged'
+
+    # Nothing visible changed, so synced copies have nothing new to fetch
+    version = current_version()
+    assert client.post('/log_activity', json={'activity': 'boarded_train_out'}).get_json()['success'] is False
+    assert current_version() == version
+
+    response = client.post('/log_activity', json={'activity': 'alighted_train_out'}).get_json()
+    assert response['success'] is True
+    assert current_version() == version + 1
+
+
+def test_replaying_a_batch_logs_nothing_twice(client):
+    tapped_at = datetime.now().replace(microsecond=0)
+    batch = [tap('a', tapped_at.isoformat()),
+             tap('b', (tapped_at + timedelta(seconds=1)).isoformat()),
+             tap('c', tapped_at.isoformat(), 'alighted_train_out')]
+    first = send_batch(client, *batch)
+    assert [result['status'] for result in first] == ['logged', 'already_logged', 'logged']
+
+    version = current_version()
+    with get_pool(commutetrackr_app.DATABASE_PATH).connection() as conn:
+        events = conn.execute('SELECT count(*) FROM commute_events').fetchone()[0]
+
+    # The response was lost, say, so the phone sends the same batch again
+    assert send_batch(client, *batch) == first
+    assert current_version() == version
+    with get_pool(commutetrackr_app.DATABASE_PATH).connection() as conn:
+        assert conn.execute('SELECT count(*) FROM commute_events').fetchone()[0] == events
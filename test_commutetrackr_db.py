@@ -0,0 +1,170 @@
+# Tests for the commute_events schema, its migrations and the record cache, on
+# database files in a temporary directory:
+#   python -m pytest test_commutetrackr_db.py
+
+import sqlite3
+import pytest
+import commutetrackr_migrate
+from commute_segments import time_columns
+from commutetrackr_cache import RecordCache
+from commutetrackr_db import create_schema
+from commutetrackr_queries import CHANGED_DATES_SQL, DEFAULT_USER_ID, get_changed_records, get_record, log_checkpoints
+
+# commute_logs as it was first created (see the top of README.md)
+WIDE_TABLE = f"""CREATE TABLE commute_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL UNIQUE,
+    {', '.join(f'{col} TEXT' for col in time_columns)}
+)"""
+
+# commute_events and friends from before there were users
+SINGLE_USER_TABLES = """
+CREATE TABLE commute_events (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    source TEXT NOT NULL,
+    logged_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE TABLE commute_log_events (
+    event_id TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    logged_time TEXT NOT NULL,
+    status TEXT NOT NULL,
+    received_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+) WITHOUT ROWID;
+CREATE TABLE commute_log_versions (
+    date TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def rows(conn, sql):
+    return [tuple(row) for row in conn.execute(sql)]
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'commutetrackr.db')
+    create_schema(path)
+    conn = connect(path)
+    yield conn
+    conn.close()
+
+
+def test_view_counts_the_first_tap_and_the_latest_override(database):
+    day = '2025-01-06'
+    log_checkpoints(database, day, {'boarded_train_out': '07:20:00', 'left_home': '07:01:00'})
+    log_checkpoints(database, day, {'boarded_train_out': '07:25:00'})
+    assert get_record(database, day)['boarded_train_out'] == '07:20:00'
+
+    # An external time or a correction replaces any tap, and the latest of them wins
+    log_checkpoints(database, day, {'boarded_train_out': '07:22:00'}, source='correction')
+    log_checkpoints(database, day, {'left_home': '07:03:00'}, source='external')
+    log_checkpoints(database, day, {'left_home': '07:02:00'}, source='external')
+    log_checkpoints(database, day, {'boarded_train_out': '07:30:00', 'left_home': '06:00:00'})
+    record = get_record(database, day)
+    assert (record['boarded_train_out'], record['left_home']) == ('07:22:00', '07:02:00')
+    assert database.execute('SELECT count(*) FROM commute_events').fetchone()[0] == 8
+
+
+def test_wide_table_migration_reads_back_the_same(tmp_path, capsys):
+    path = str(tmp_path / 'commutetrackr.db')
+    conn = sqlite3.connect(path)
+    conn.execute(WIDE_TABLE)
+    conn.executemany('INSERT INTO commute_logs (date, left_home, boarded_train_out, arrived_at_home) VALUES (?, ?, ?, ?)',
+                     [('2025-01-06', '07:01:00', '07:20:00', '18:18:00'),
+                      ('2025-01-07', '07:02:00', '', None),
+                      ('2025-01-08', None, None, None)])
+    conn.commit()
+    conn.close()
+
+    assert commutetrackr_migrate.main([path]) == 0
+    assert 'reads back the same' in capsys.readouterr().out
+
+    conn = connect(path)
+    try:
+        assert commutetrackr_migrate.compare_days(conn) == []
+        assert conn.execute('SELECT count(*) FROM commute_logs_wide').fetchone()[0] == 3
+        assert conn.execute("SELECT count(*) FROM commute_events WHERE source = 'migration'").fetchone()[0] == 4
+        # The days' values haven't changed, so synced copies don't need to fetch them again
+        assert conn.execute('SELECT count(*) FROM commute_log_versions').fetchone()[0] == 0
+        assert get_record(conn, '2025-01-06')['arrived_at_home'] == '18:18:00'
+    finally:
+        conn.close()
+    # The backup is the untouched wide table
+    backup = sqlite3.connect(f'{path}.pre-events')
+    assert backup.execute("SELECT type FROM sqlite_master WHERE name = 'commute_logs'").fetchone()[0] == 'table'
+    backup.close()
+
+    # Running it again finds nothing to do
+    assert commutetrackr_migrate.main([path]) == 0
+    assert 'Nothing to do' in capsys.readouterr().out
+
+
+def test_single_user_database_is_given_to_the_original_user(tmp_path):
+    path = str(tmp_path / 'commutetrackr.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(SINGLE_USER_TABLES)
+    conn.execute("INSERT INTO commute_events (date, activity, ts, source) VALUES ('2025-01-06', 'left_home', '07:01:00', 'button')")
+    conn.execute("INSERT INTO commute_log_events (event_id, date, activity, logged_time, status) "
+                 "VALUES ('a', '2025-01-06', 'left_home', '07:01:00', 'logged')")
+    conn.execute("INSERT INTO commute_log_versions VALUES ('2025-01-06', 7)")
+    conn.commit()
+    conn.close()
+
+    create_schema(path)
+    conn = connect(path)
+    try:
+        assert rows(conn, 'SELECT DISTINCT user_id FROM commute_events') == [(DEFAULT_USER_ID,)]
+        assert rows(conn, 'SELECT user_id FROM commute_log_events') == [(DEFAULT_USER_ID,)]
+        assert rows(conn, 'SELECT user_id, date, version FROM commute_log_versions') == [
+            (DEFAULT_USER_ID, '2025-01-06', 7)]
+        assert get_record(conn, '2025-01-06')['left_home'] == '07:01:00'
+        # The segment tables were rebuilt with a user_id, ready to be backfilled
+        assert 'user_id' in {info[1] for info in conn.execute('PRAGMA table_info(commute_legs)')}
+    finally:
+        conn.close()
+
+
+def test_record_cache_reloads_after_another_connection_commits(database, tmp_path):
+    path = str(tmp_path / 'commutetrackr.db')
+    cache = RecordCache(path)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return get_record(database, '2025-01-06')
+
+    assert cache.get('2025-01-06', load)['left_home'] is None
+    assert cache.get('2025-01-06', load)['left_home'] is None
+    assert len(loads) == 1
+
+    other = connect(path)
+    log_checkpoints(other, '2025-01-06', {'left_home': '07:01:00'}, source='external')
+    other.commit()
+    other.close()
+
+    assert cache.get('2025-01-06', load)['left_home'] == '07:01:00'
+    assert len(loads) == 2
+
+
+def test_changed_days_are_found_through_the_version_index(database):
+    for day in ('2025-01-08', '2025-01-06', '2025-01-07'):
+        log_checkpoints(database, day, {'left_home': '07:01:00'})
+    database.commit()
+
+    plan = ' '.join(row[3] for row in database.execute('EXPLAIN QUERY PLAN ' + CHANGED_DATES_SQL, (DEFAULT_USER_ID, 1, '')))
+    assert 'idx_commute_log_versions_user_version' in plan
+    version, records = get_changed_records(database, since_version=1)
+    assert version == 3
+    assert [(record['date'], record['row_version']) for record in records] == [('2025-01-06', 2), ('2025-01-07', 3)]
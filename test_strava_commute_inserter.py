@@ -0,0 +1,144 @@
+# Tests for strava_commute_inserter.py against strava_stub.py, run on a free local port:
+#   python -m pytest test_strava_commute_inserter.py
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import pytest
+import requests
+import strava_commute_inserter as inserter
+from strava_stub import StubHandler
+
+
+def serve(handler):
+    """Start a server on a free port in a background thread, returning it and its URL"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+@pytest.fixture
+def stub(monkeypatch, tmp_path):
+    """strava_stub.py on a free port, with the inserter pointed at it and a token cache of its own"""
+    monkeypatch.setattr(StubHandler, 'counts', {})
+    monkeypatch.setattr(StubHandler, 'rate_limit_every', 0)
+    server, url = serve(StubHandler)
+    monkeypatch.setattr(inserter, 'STRAVA_URL', url)
+    monkeypatch.setattr(inserter, 'TOKEN_CACHE_PATH', str(tmp_path / 'strava_token.json'))
+    yield StubHandler
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """The inserter's rate-limit waits, recorded instead of slept"""
+    waits = []
+    # Only the inserter's own time module is swapped, so the stub still works as normal
+    monkeypatch.setattr(inserter, 'time', SimpleNamespace(time=time.time, sleep=waits.append))
+    return waits
+
+
+def test_token_is_cached_between_runs(stub):
+    for _ in range(3):
+        with inserter.make_session() as session:
+            inserter.authorise(session)
+            assert session.headers['Authorization'] == 'Bearer stub-access'
+    assert stub.counts == {'token': 1}
+
+    with open(inserter.TOKEN_CACHE_PATH) as f:
+        assert json.load(f)['refresh_token'] == 'stub-refresh'
+    assert os.stat(inserter.TOKEN_CACHE_PATH).st_mode & 0o777 == 0o600
+
+
+def test_expired_token_is_refreshed(stub):
+    inserter.save_cached_token({'access_token': 'old', 'refresh_token': 'stub-refresh',
+                                'expires_at': int(time.time()) + inserter.TOKEN_EXPIRY_MARGIN - 1})
+    with inserter.make_session() as session:
+        inserter.authorise(session)
+        assert session.headers['Authorization'] == 'Bearer stub-access'
+    assert stub.counts == {'token': 1}
+
+
+def test_rate_limit_backs_off_for_retry_after(stub, sleeps):
+    # The stub counts the token request too, so the first activities request is the 429
+    stub.rate_limit_every = 2
+    with inserter.make_session() as session:
+        inserter.authorise(session)
+        assert inserter.strava_get(session, 'athlete/activities', {'after': 0, 'before': 1}) == []
+    assert sleeps == [1.0]
+    assert stub.counts == {'token': 1, 'activities': 2}
+
+
+def test_rate_limit_wait_is_capped_and_gives_up(stub, sleeps, monkeypatch):
+    monkeypatch.setattr(inserter, 'MAX_RATE_LIMIT_WAIT', 0.5)
+    stub.rate_limit_every = 1
+    with inserter.make_session() as session:
+        inserter.authorise(session)
+        with pytest.raises(requests.HTTPError):
+            inserter.strava_get(session, 'athlete/activities', {'after': 0, 'before': 1})
+    assert sleeps == [0.5] * inserter.RATE_LIMIT_RETRIES
+    assert stub.counts['activities'] == inserter.RATE_LIMIT_RETRIES + 1
+
+
+def test_stub_rides_map_onto_cycling_checkpoints(stub):
+    with inserter.make_session() as session:
+        inserter.authorise(session)
+        # Friday 2025-01-03 to Monday 2025-01-06 inclusive: the weekend has no rides
+        rides = inserter.fetch_rides(session, datetime(2025, 1, 3), datetime(2025, 1, 7))
+
+    assert sorted(day.isoformat() for day in rides) == ['2025-01-03', '2025-01-06']
+    for day_rides in rides.values():
+        assert inserter.commute_checkpoints(day_rides) == {
+            'left_home': '07:01:00', 'arrived_at_station': '07:15:00',
+            'left_station': '18:03:00', 'arrived_at_home': '18:18:00',
+        }
+
+
+def test_commute_checkpoints_ignores_rides_in_between():
+    def ride(start, minutes):
+        start = datetime.fromisoformat(f'2025-01-06T{start}')
+        return start, start.replace(minute=start.minute + minutes)
+
+    assert inserter.commute_checkpoints([ride('12:30:00', 20), ride('07:00:00', 14)]) == {
+        'left_home': '07:00:00', 'arrived_at_station': '07:14:00',
+        'left_station': '12:30:00', 'arrived_at_home': '12:50:00',
+    }
+    assert inserter.commute_checkpoints([ride('18:00:00', 15), ride('13:00:00', 10), ride('07:00:00', 14)]) == {
+        'left_home': '07:00:00', 'arrived_at_station': '07:14:00',
+        'left_station': '18:00:00', 'arrived_at_home': '18:15:00',
+    }
+    assert inserter.commute_checkpoints([ride('13:00:00', 10), ride('18:00:00', 15)]) == {
+        'left_station': '18:00:00', 'arrived_at_home': '18:15:00',
+    }
+
+
+class SlowCommuteTrackr(BaseHTTPRequestHandler):
+    """Answers every POST too late, as a Pi that has committed but not replied yet would"""
+    posts = 0
+
+    def do_POST(self):
+        type(self).posts += 1
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(0.5)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_posts_are_not_retried_after_a_read_timeout():
+    server, url = serve(SlowCommuteTrackr)
+    try:
+        with inserter.make_session() as session:
+            with pytest.raises(requests.Timeout):
+                session.post(f'{url}/api/log_external/bulk', json={'days': []}, timeout=(5, 0.1))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert SlowCommuteTrackr.posts == 1